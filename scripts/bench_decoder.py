@@ -0,0 +1,690 @@
+#!/usr/bin/env python3
+"""
+BLE Decoder Benchmarks
+Measures hot-path costs of ble_decoder.py without a broker or govee2mqtt API.
+
+Usage:
+  python3 scripts/bench_decoder.py lookup          # device lookup vs fleet size
+  python3 scripts/bench_decoder.py lookup --sizes 10 1000 100000
+  python3 scripts/bench_decoder.py influx          # line-protocol writer vs a stub InfluxDB
+  python3 scripts/bench_decoder.py alloc           # output string building, per-message vs cached
+  python3 scripts/bench_decoder.py decode          # compiled spec decoders vs hand-written ones
+  python3 scripts/bench_decoder.py batch           # NumPy decode_batch vs one-at-a-time (needs numpy)
+  python3 scripts/bench_decoder.py parse           # JSON backends on recorded gateway payloads
+  python3 scripts/bench_decoder.py suite           # golden-corpus check + timings saved as JSON
+  python3 scripts/bench_decoder.py suite --compare scripts/bench_data/results/<earlier>.json
+"""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ble_decoder  # noqa: E402
+
+# Representative OpenMQTTGateway/Theengs payloads (data adverts, name-only scan
+# responses, iBeacons, other vendors), one {"topic", "payload"} object per line
+GATEWAY_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data", "gateway-payloads.jsonl")
+
+# Golden adverts per SKU and gateway type with the decode and published fields
+# they must produce; `suite` checks them before timing and saves results here
+GOLDEN_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data", "golden-packets.jsonl")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data", "results")
+
+
+# ============================================================================
+# Helpers
+# ============================================================================
+
+def random_mac(rng):
+    """Random 12-char uppercase hex MAC (no colons), like the decoder sees."""
+    return "".join(rng.choice("0123456789ABCDEF") for _ in range(12))
+
+
+def synthetic_devices(count, rng):
+    """Build a DEVICES-style map with `count` registered sensors."""
+    devices = {}
+    while len(devices) < count:
+        devices[random_mac(rng)] = {
+            "name": f"sensor_{len(devices)}",
+            "room": "bench",
+            "sku": "H5075",
+            "has_override": False,
+        }
+    return devices
+
+
+def linear_lookup(devices, mac):
+    """The pre-index lookup from on_message, kept here as the baseline."""
+    for suffix, info in devices.items():
+        if suffix.endswith(mac) or mac.endswith(suffix[-len(mac):]):
+            return info
+    return None
+
+
+def peak_bytes(func, items):
+    """Average tracemalloc peak (bytes held at once) per call of func(item)."""
+    total = 0
+    tracemalloc.start()
+    for item in items:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = func(item)
+        total += tracemalloc.get_traced_memory()[1] - before
+        del result
+    tracemalloc.stop()
+    return total / len(items)
+
+
+def per_call_ns(func, macs, repeat):
+    """Best-of-`repeat` average nanoseconds per call of func(mac)."""
+    def run():
+        for mac in macs:
+            func(mac)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(macs) * 1e9
+
+
+# ============================================================================
+# Benchmarks
+# ============================================================================
+
+def bench_lookup(args):
+    """Per-message device lookup cost, index vs linear scan, across fleet sizes."""
+    rng = random.Random(args.seed)
+    print(f"{'devices':>8} {'index hit':>11} {'index miss':>11} {'scan hit':>11} {'scan miss':>11}  (ns/lookup)")
+    for size in args.sizes:
+        devices = synthetic_devices(size, rng)
+        index = ble_decoder.DeviceIndex(devices)
+        known = rng.sample(list(devices), min(args.samples, size))
+        unknown = [random_mac(rng) for _ in range(args.samples)]
+
+        row = [
+            per_call_ns(index.lookup, known, args.repeat),
+            per_call_ns(index.lookup, unknown, args.repeat),
+        ]
+        if size <= args.scan_limit:
+            row.append(per_call_ns(lambda m: linear_lookup(devices, m), known, args.repeat))
+            row.append(per_call_ns(lambda m: linear_lookup(devices, m), unknown, args.repeat))
+        cells = " ".join(f"{v:>11.0f}" for v in row)
+        print(f"{size:>8} {cells}")
+    return 0
+
+
+def legacy_decode_h5051(b):
+    """Hand-written H5051 decoder from before DECODER_SPECS, kept as the baseline."""
+    if len(b) < 8:
+        return None
+    temp_raw = b[3] | (b[4] << 8)
+    return {
+        "temp_f": (temp_raw / 100.0) * 9.0 / 5.0 + 32.0,  # Fahrenheit
+        "humidity": b[5] / 10.0,
+        "battery": b[7]
+    }
+
+
+def legacy_decode_h507x(b):
+    """Decode Govee H5074/H5072 manufacturer data (little-endian)."""
+    if len(b) < 8:
+        return None
+    # Reject iBeacon packets (start with 4c00) and other non-Govee packets
+    if b[0] == 0x4c:  # Apple iBeacon
+        return None
+    # Validate Govee manufacturer header (88ec or 0188ec)
+    if not (b[0] == 0x88 and b[1] == 0xec):
+        return None
+    # Little-endian 16-bit values in hundredths
+    temp_raw = b[3] | (b[4] << 8)
+    hum_raw = b[5] | (b[6] << 8)
+    return {
+        "temp_f": (temp_raw / 100.0) * 9.0 / 5.0 + 32.0,  # Fahrenheit
+        "humidity": hum_raw / 100.0,
+        "battery": b[7] if len(b) > 7 else 100
+    }
+
+
+def legacy_decode_h5075(b):
+    """Decode Govee H5075 manufacturer data (big-endian, different encoding)."""
+    if len(b) < 7:
+        return None
+    # Reject iBeacon packets
+    if b[0] == 0x4c:
+        return None
+    # Validate Govee manufacturer header
+    if not (b[0] == 0x88 and b[1] == 0xec):
+        return None
+    
+    # Temperature: bytes 3-4, BIG-endian (different from H5074!)
+    # Empirical formula derived from sample data: tempC = (raw + 16) / 40
+    temp_raw = (b[3] << 8) | b[4]
+    temp_c = (temp_raw + 16) / 40.0
+    temp_f = temp_c * 9.0 / 5.0 + 32.0
+    
+    # Humidity: byte 5
+    # Empirical approximation (refined formula TBD with more varying samples)
+    humidity = (b[5] - 135) / 2.5
+    
+    return {
+        "temp_f": temp_f,
+        "humidity": max(0, min(100, humidity)),  # Clamp to valid 0-100 range
+        "battery": b[6] if len(b) > 6 else 100
+    }
+
+
+LEGACY_DECODERS = {
+    "H5051": legacy_decode_h5051,
+    "H5074": legacy_decode_h507x,
+    "H5072": legacy_decode_h507x,
+    "H5075": legacy_decode_h5075,
+}
+
+
+def synthetic_packets(count, rng):
+    """Random manufacturer data, mostly with a valid Govee header and length."""
+    packets = []
+    for _ in range(count):
+        packet = bytes(rng.randrange(256) for _ in range(rng.choice((6, 7, 8, 8, 8, 9))))
+        if rng.random() < 0.9:
+            packet = b"\x88\xec" + packet[2:]
+        packets.append(packet)
+    return packets
+
+
+def load_gateway_corpus():
+    """[(topic, payload bytes)] from bench_data/gateway-payloads.jsonl."""
+    with open(GATEWAY_CORPUS) as f:
+        return [(row["topic"], row["payload"].encode()) for row in map(json.loads, f) if row]
+
+
+def legacy_output_strings(topic, device, mac, fields):
+    """Per-message topic building from before OutputCache, kept as the baseline."""
+    source_node = ble_decoder.extract_source_node(topic)
+    base_topic = (f"{ble_decoder.SHOWSITE}/{ble_decoder.DECODER_NODE}/{source_node}/"
+                  f"{device['room']}/{device['name']}/{mac}")
+    return [f"{base_topic}/{metric}" for metric in fields]
+
+
+def cached_output_strings(topic, device, mac, fields):
+    source_node = ble_decoder.TOPICS[topic][1]
+    topics = ble_decoder.OUTPUT_CACHE.get(source_node, device, mac)[0]
+    return [topics[metric] for metric in fields]
+
+
+def bench_decode(args):
+    """Compiled DECODER_SPECS decoders vs the hand-written functions, with an equality check."""
+    rng = random.Random(args.seed)
+    packets = synthetic_packets(args.samples, rng)
+    print(f"{'model':>6} {'hand-written':>13} {'compiled':>10} {'speedup':>8}  (ns/decode)")
+    mismatches = 0
+    for sku, legacy in LEGACY_DECODERS.items():
+        compiled = ble_decoder.DECODERS[sku]
+        for packet in packets:
+            expected, actual = legacy(packet), compiled(packet)
+            if repr(expected) != repr(actual):  # repr also catches int vs float
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"  MISMATCH {sku} {packet.hex()}: {expected} != {actual}")
+        old = per_call_ns(legacy, packets, args.repeat)
+        new = per_call_ns(compiled, packets, args.repeat)
+        print(f"{sku:>6} {old:>13.0f} {new:>10.0f} {old / new:>7.2f}x")
+    print(f"outputs identical on {args.samples} packets per model: {'yes' if not mismatches else 'NO'}")
+    return 1 if mismatches else 0
+
+
+def bench_batch(args):
+    """Packets/sec of decode_batch vs per-packet fromhex + DECODERS, with a bit-level equality check."""
+    if ble_decoder.np is None:
+        print("decode_batch needs NumPy: pip install numpy")
+        return 1
+    rng = random.Random(args.seed)
+    hex_payloads = [packet.hex() for packet in synthetic_packets(args.packets, rng)]
+    skus = [rng.choice(list(LEGACY_DECODERS)) for _ in hex_payloads]
+
+    def one_at_a_time():
+        return [ble_decoder.DECODERS[sku](bytes.fromhex(mfr)) for mfr, sku in zip(hex_payloads, skus)]
+
+    scalar_time = min(timeit.repeat(one_at_a_time, number=1, repeat=args.repeat))
+    batch_time = min(timeit.repeat(lambda: ble_decoder.decode_batch(hex_payloads, skus),
+                                   number=1, repeat=args.repeat))
+
+    mismatches = 0
+    columns = ble_decoder.decode_batch(hex_payloads, skus)
+    for i, decoded in enumerate(one_at_a_time()):
+        if decoded is None:
+            same = not columns["valid"][i]
+        else:
+            same = columns["valid"][i] and all(
+                float(columns[k][i]).hex() == float(v).hex() for k, v in decoded.items())
+        mismatches += not same
+
+    print(f"packets:        {args.packets} ({columns['valid'].sum()} valid)")
+    print(f"one at a time:  {args.packets / scalar_time:>12,.0f} packets/s")
+    print(f"decode_batch:   {args.packets / batch_time:>12,.0f} packets/s ({scalar_time / batch_time:.1f}x)")
+    print(f"bit-identical:  {'yes' if not mismatches else f'NO ({mismatches} rows differ)'}")
+    return 1 if mismatches else 0
+
+
+def bench_parse(args):
+    """Parse cost per gateway message for each available JSON backend."""
+    corpus = load_gateway_corpus()
+    payloads = [payload for _, payload in corpus] * max(1, args.messages // len(corpus))
+    print(f"corpus: {len(corpus)} payloads ({sum(map(len, (p for _, p in corpus))) // len(corpus)} bytes avg), "
+          f"active backend: {ble_decoder.JSON_BACKEND}")
+    baseline = None
+    for name, (loads, _) in ble_decoder.JSON_BACKENDS.items():
+        ns = per_call_ns(loads, payloads, args.repeat)
+        baseline = baseline or ns
+        print(f"{name:<8} {ns:>8.0f} ns/message ({baseline / ns:.1f}x stdlib)")
+    if "orjson" not in ble_decoder.JSON_BACKENDS:
+        print("orjson not installed (pip install orjson) - stdlib only")
+    return 0
+
+
+class FakeClient:
+    """Stands in for paho: accepts publishes and drops them."""
+
+    class Result:
+        rc = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self.Result
+
+    def is_connected(self):
+        return True
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def bench_alloc(args):
+    """Output-string cost per message (legacy f-strings vs cache) and the full on_message path."""
+    rng = random.Random(args.seed)
+    devices = synthetic_devices(args.devices, rng)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        ble_decoder.install_devices(devices)
+        ble_decoder.LOG.flush()  # the device list is logged, keep it out of the results
+    fields = {"temperature": 71.3, "humidity": 44.2, "battery": 90, "rssi": -61}
+    gateways = [f"dpx_ops_{i}" for i in range(1, 4)]
+    messages = []
+    for _ in range(args.messages):
+        mac = rng.choice(list(devices))
+        topic = f"{ble_decoder.SHOWSITE}/{rng.choice(gateways)}/BTtoMQTT/{mac}"
+        messages.append((topic, devices[mac], mac))
+    for topic, device, mac in messages:
+        cached_output_strings(topic, device, mac, fields)  # warm the caches
+
+    print(f"{'output strings':<22} {'ns/msg':>10} {'peak B/msg':>12}")
+    for label, func in (("per-message f-strings", legacy_output_strings),
+                        ("cached (OutputCache)", cached_output_strings)):
+        call = lambda m: func(m[0], m[1], m[2], fields)  # noqa: E731
+        print(f"{label:<22} {per_call_ns(call, messages, args.repeat):>10.0f} "
+              f"{peak_bytes(call, messages):>12.0f}")
+
+    # Whole pipeline: on_message -> decode -> publish (scalar, inline, no broker)
+    client = FakeClient()
+    payload = json.dumps({"id": "", "tempf": 71.3, "hum": 44.2, "batt": 90, "rssi": -61}).encode()
+    msgs = [FakeMessage(topic, payload) for topic, _, _ in messages]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        ns = per_call_ns(lambda m: ble_decoder.on_message(client, None, m), msgs, args.repeat)
+        peak = peak_bytes(lambda m: ble_decoder.on_message(client, None, m), msgs)
+        ble_decoder.LOG.flush()  # sampled reading lines go to devnull too
+    print(f"{'on_message (full path)':<22} {ns:>10.0f} {peak:>12.0f}")
+    return 0
+
+
+class StubInflux(BaseHTTPRequestHandler):
+    """Accepts /api/v2/write like InfluxDB and counts the lines received."""
+
+    lines = 0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        with StubInflux.lock:
+            StubInflux.lines += body.count(b"\n") + 1
+            StubInflux.requests += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_influx(args):
+    """End-to-end throughput of InfluxWriter posting to a local stub server."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubInflux)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    rng = random.Random(args.seed)
+    devices = list(synthetic_devices(args.devices, rng).items())
+    fields = {"temperature": 71.3, "humidity": 44.2, "battery": 90, "rssi": -61}
+    expected = args.readings * len(fields)
+
+    writer = ble_decoder.InfluxWriter(url, "bench", "home", "sensors",
+                                      args.batch, args.flush, expected)
+    writer.start()
+    ts = int(time.time() * 1000)
+    start = time.perf_counter()
+    for i in range(args.readings):
+        mac, device = devices[i % len(devices)]
+        writer.write_reading("dpx_ops_1", device, mac, fields, ts + i)
+    queued = time.perf_counter() - start
+    while StubInflux.lines < expected and time.perf_counter() - start < args.timeout:
+        time.sleep(0.01)
+    total = time.perf_counter() - start
+    server.shutdown()
+
+    print(f"readings:     {args.readings} ({expected} lines, batch {args.batch})")
+    print(f"enqueue:      {queued / args.readings * 1e6:.2f} us/reading (decoder thread cost)")
+    print(f"delivered:    {StubInflux.lines} lines in {StubInflux.requests} requests, {total:.2f}s")
+    print(f"throughput:   {StubInflux.lines / total:,.0f} lines/s")
+    return 0 if StubInflux.lines >= expected else 1
+
+
+def load_golden_corpus(path=GOLDEN_CORPUS):
+    """Rows of golden-packets.jsonl: sku (None for junk), gateway, topic, payload, decoded, published."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def golden_mac(row):
+    """MAC a corpus row is from (topic, or the payload id on undecoded topics)."""
+    mac = ble_decoder.topic_mac(row["topic"])
+    return mac or json.loads(row["payload"])["id"].replace(":", "").upper()
+
+
+def golden_packet(row):
+    """Raw manufacturer data of a corpus row, or None if the gateway only sent decoded values."""
+    mfr = json.loads(row["payload"]).get("manufacturerdata")
+    return bytes.fromhex(mfr) if mfr else None
+
+
+def golden_devices(corpus):
+    """DEVICES-style map registering every corpus MAC with a SKU (junk stays unknown)."""
+    devices = {}
+    for row in corpus:
+        if row["sku"]:
+            mac = golden_mac(row)
+            devices[mac] = {"name": f"golden_{row['sku'].lower()}_{mac[-4:]}", "room": "bench",
+                            "sku": row["sku"], "has_override": False}
+    return devices
+
+
+class CapturingClient(FakeClient):
+    """FakeClient that keeps publishes so the suite can check what was sent."""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return self.Result
+
+
+def published_fields(client, row):
+    """Metrics on_message publishes for one corpus row ({} if it is dropped)."""
+    client.published.clear()
+    ble_decoder.on_message(client, None, FakeMessage(row["topic"], row["payload"].encode()))
+    fields = {}
+    for topic, payload in client.published:
+        if ble_decoder.OUTPUT_MODE == "json":
+            document = json.loads(payload)
+            for tag in ("ts", "source_node", "room", "device_name", "z_device_id"):
+                document.pop(tag, None)
+            fields.update(document)
+        else:
+            fields[topic.rsplit("/", 1)[1]] = payload
+    return fields
+
+
+def check_golden(corpus):
+    """Mismatches between the corpus expectations and this decoder (empty list = all match)."""
+    def same(a, b):
+        return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)  # also tells 100 from 100.0
+
+    client = CapturingClient()
+    problems = []
+    for i, row in enumerate(corpus, 1):
+        packet = golden_packet(row)
+        if row["sku"] and packet is not None:
+            decoded = ble_decoder.DECODERS[row["sku"]](packet)
+            if not same(decoded, row["decoded"]):
+                problems.append(f"line {i} {row['sku']} {packet.hex()}: decoded {decoded}, expected {row['decoded']}")
+        published = published_fields(client, row)
+        if not same(published, row["published"]):
+            problems.append(f"line {i} {row['gateway']} {row['topic']}: published {published}, "
+                            f"expected {row['published']}")
+    return problems
+
+
+def time_rounds(func, items, rounds, min_time):
+    """Per-call ns of func(item) for each round; a round repeats items until it lasts min_time."""
+    def run(passes):
+        start = time.perf_counter()
+        for _ in range(passes):
+            for item in items:
+                func(item)
+        return time.perf_counter() - start
+
+    passes = 1
+    while run(passes) < min_time:
+        passes *= 2
+    return [run(passes) / (passes * len(items)) * 1e9 for _ in range(rounds)], passes * len(items)
+
+
+def summarize(samples, calls):
+    """pytest-benchmark style statistics (ns per call) for one benchmark."""
+    median = statistics.median(samples)
+    return {
+        "min": round(min(samples), 2),
+        "max": round(max(samples), 2),
+        "mean": round(statistics.fmean(samples), 2),
+        "stddev": round(statistics.stdev(samples), 2) if len(samples) > 1 else 0.0,
+        "median": round(median, 2),
+        "ops": round(1e9 / median, 1),
+        "rounds": len(samples),
+        "calls_per_round": calls,
+    }
+
+
+def suite_benchmarks(corpus):
+    """(name, group, func, items) for every suite benchmark, per function then end to end."""
+    benchmarks = []
+    for sku in sorted({row["sku"] for row in corpus if row["sku"]}):
+        packets = [golden_packet(row) for row in corpus if row["sku"] == sku and golden_packet(row)]
+        decoder = ble_decoder.DECODERS[sku]
+        benchmarks.append((f"decode.{sku}", "decode", decoder, packets))
+        # What process_message does per packet: uncached (fromhex + decode) vs through the LRU
+        benchmarks.append((f"decode_hex.{sku}", "decode", lambda mfr, decoder=decoder: decoder(bytes.fromhex(mfr)),
+                           [packet.hex() for packet in packets]))
+        if sku in ble_decoder.DECODE_CACHES:
+            benchmarks.append((f"decode_cached.{sku}", "decode", ble_decoder.DECODE_CACHES[sku].decode,
+                               [packet.hex() for packet in packets]))
+    topics = [row["topic"] for row in corpus]
+    benchmarks += [
+        ("extract_source_node", "topic", ble_decoder.extract_source_node, topics),
+        ("parse_input_topic", "topic", ble_decoder.parse_input_topic, topics),
+        ("topic_mac", "topic", ble_decoder.topic_mac, topics),
+        ("device_lookup", "lookup", ble_decoder.DEVICE_INDEX.lookup, [golden_mac(row) for row in corpus]),
+        (f"json_loads.{ble_decoder.JSON_BACKEND}", "parse", ble_decoder.json_loads,
+         [row["payload"].encode() for row in corpus]),
+    ]
+
+    # Whole pipeline per gateway type: on_message -> parse -> decode -> publish (inline, no broker)
+    client = FakeClient()
+    on_message = lambda message: ble_decoder.on_message(client, None, message)  # noqa: E731
+    messages = {}
+    for row in corpus:
+        messages.setdefault(row["gateway"], []).append(FakeMessage(row["topic"], row["payload"].encode()))
+    for gateway in sorted(messages):
+        benchmarks.append((f"on_message.{gateway}", "on_message", on_message, messages[gateway]))
+    benchmarks.append(("on_message.all", "on_message", on_message,
+                       [message for batch in messages.values() for message in batch]))
+    return benchmarks
+
+
+def compare_results(results, previous, threshold):
+    """Print median changes against an earlier results file; returns the benchmarks that slowed down."""
+    before = {bench["name"]: bench["stats"]["median"] for bench in previous["benchmarks"]}
+    print(f"\nvs {previous['version']} ({previous['datetime']}, {previous['machine']['python']}):")
+    if previous["corpus"]["sha256"] != results["corpus"]["sha256"]:
+        print("  note: golden corpus changed since then, per-item costs may not be comparable")
+    slower = []
+    for bench in results["benchmarks"]:
+        old = before.get(bench["name"])
+        if not old:
+            print(f"  {bench['name']:<28} new")
+            continue
+        change = bench["stats"]["median"] / old - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            slower.append(bench["name"])
+        print(f"  {bench['name']:<28} {old:>10.0f} -> {bench['stats']['median']:>8.0f} ns {change:>+7.1%}{flag}")
+    return slower
+
+
+def bench_suite(args):
+    """Check the golden corpus, then time every benchmark and save the results as JSON."""
+    with open(args.corpus, "rb") as f:
+        corpus_hash = hashlib.sha256(f.read()).hexdigest()
+    corpus = load_golden_corpus(args.corpus)
+    results = {
+        "version": ble_decoder.VERSION,
+        "datetime": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "json_backend": ble_decoder.JSON_BACKEND,
+            "decode_cache": ble_decoder.DECODE_CACHE_SIZE,
+            "output": ble_decoder.OUTPUT_MODE,
+            "log_readings": ble_decoder.LOG_READINGS,
+        },
+        "corpus": {"file": os.path.basename(args.corpus), "sha256": corpus_hash, "rows": len(corpus)},
+        "benchmarks": [],
+    }
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        ble_decoder.install_devices(golden_devices(corpus))
+        ble_decoder.LOG.flush()  # write the device list before anything is timed
+        problems = check_golden(corpus)
+        if not problems:
+            for name, group, func, items in suite_benchmarks(corpus):
+                if args.filter and args.filter not in name:
+                    continue
+                samples, calls = time_rounds(func, items, args.rounds, args.min_time)
+                results["benchmarks"].append({"name": name, "group": group, "stats": summarize(samples, calls)})
+        ble_decoder.LOG.flush()  # sampled reading lines go to devnull too
+
+    if problems:
+        print(f"golden corpus check FAILED ({len(problems)} rows) - nothing timed:")
+        for problem in problems[:20]:
+            print(f"  {problem}")
+        print("(the corpus expects default decoder settings: no DECODER_DEDUP/DEADBAND/AGGREGATE)")
+        return 1
+
+    print(f"golden corpus: {len(corpus)} rows OK, decoder {ble_decoder.VERSION}, "
+          f"Python {results['machine']['python']}, json {ble_decoder.JSON_BACKEND}")
+    print(f"{'benchmark':<28} {'median ns':>10} {'min':>8} {'stddev':>8} {'ops/s':>12}")
+    for bench in results["benchmarks"]:
+        stats = bench["stats"]
+        print(f"{bench['name']:<28} {stats['median']:>10.0f} {stats['min']:>8.0f} "
+              f"{stats['stddev']:>8.1f} {stats['ops']:>12,.0f}")
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{ble_decoder.VERSION}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare_results(results, json.load(f), args.threshold)
+        if slower and args.strict:
+            return 1
+    return 0
+
+
+def main():
+    """Main CLI entry point."""
+    parser = argparse.ArgumentParser(description="Benchmark ble_decoder.py hot paths")
+    parser.add_argument("--seed", type=int, default=1234, help="RNG seed for synthetic data")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repeats (best is reported)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("lookup", help="Device lookup cost vs number of registered devices")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    p.add_argument("--samples", type=int, default=2000, help="Lookups per measurement")
+    p.add_argument("--scan-limit", type=int, default=10000,
+                   help="Skip the linear-scan baseline above this fleet size")
+    p.set_defaults(func=bench_lookup)
+
+    p = sub.add_parser("influx", help="InfluxWriter throughput against a stub /api/v2/write")
+    p.add_argument("--readings", type=int, default=50000)
+    p.add_argument("--devices", type=int, default=100)
+    p.add_argument("--batch", type=int, default=ble_decoder.INFLUX_BATCH)
+    p.add_argument("--flush", type=float, default=ble_decoder.INFLUX_FLUSH)
+    p.add_argument("--timeout", type=float, default=60, help="Give up waiting for delivery after this many seconds")
+    p.set_defaults(func=bench_influx)
+
+    p = sub.add_parser("decode", help="Compiled spec decoders vs the old hand-written functions")
+    p.add_argument("--samples", type=int, default=20000, help="Random packets per model")
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("batch", help="NumPy decode_batch throughput vs per-packet decoding")
+    p.add_argument("--packets", type=int, default=200000)
+    p.set_defaults(func=bench_batch)
+
+    p = sub.add_parser("parse", help="JSON backend parse cost on recorded gateway payloads")
+    p.add_argument("--messages", type=int, default=50000)
+    p.set_defaults(func=bench_parse)
+
+    p = sub.add_parser("alloc", help="Output topic building per message vs cached, plus full on_message")
+    p.add_argument("--devices", type=int, default=200)
+    p.add_argument("--messages", type=int, default=20000)
+    p.set_defaults(func=bench_alloc)
+
+    p = sub.add_parser("suite", help="Golden-corpus check, then per-function and on_message timings as JSON")
+    p.add_argument("--corpus", default=GOLDEN_CORPUS)
+    p.add_argument("--rounds", type=int, default=15)
+    p.add_argument("--min-time", type=float, default=0.02, help="Seconds per round (items repeated to fill it)")
+    p.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    p.add_argument("--output", help="Results file (default: scripts/bench_data/results/<version>-<time>.json)")
+    p.add_argument("--compare", help="Earlier results file to compare medians against")
+    p.add_argument("--threshold", type=float, default=0.10, help="Slowdown counted as a regression")
+    p.add_argument("--strict", action="store_true", help="Exit 1 if --compare finds a regression")
+    p.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
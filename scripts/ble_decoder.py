@@ -13,14 +13,46 @@ Topic Structure: {site}/{node}/{source_node}/{room}/{device}/{metric}
 """
 
 from datetime import datetime
+import cProfile
+import functools
+import io
 import json
+import math
 import os
+import queue
+import signal
+import socket
+import struct
+import gzip
+import urllib.error
+import urllib.parse
 import urllib.request
+import zlib
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import paho.mqtt.client as mqtt
+import pstats
 import sys
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime
 from pathlib import Path
 
+# Optional: only decode_batch() (bulk replay) needs NumPy; the live decoder doesn't
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Optional: faster JSON parsing/serialising (see JSON_BACKEND)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Read version from VERSION file (parent dir for local, same dir in container)
 VERSION_FILE_PARENT = Path(__file__).parent.parent / "VERSION"
 VERSION_FILE_SAME = Path(__file__).parent / "VERSION"
@@ -43,149 +75,972 @@ API = "http://localhost:8056/api/devices"
 SHOWSITE = os.getenv("SHOWSITE_NAME", "demo_showsite")
 DECODER_NODE = "dpx_ops_decoder"
 
+# Output mode:
+#   scalar - one message per metric: {site}/{node}/{source}/{room}/{device}/{mac}/{metric}
+#   json   - one JSON document per reading: {site}/{node}_json/{source}/{room}/{device}/{mac}
+#            (Telegraf input for it: ble_decoder.py --telegraf-json-config)
+OUTPUT_MODE = os.getenv("DECODER_OUTPUT", "scalar").lower()
+JSON_NODE = f"{DECODER_NODE}_json"
+
+# Logging (rendered and written by a background thread, see Logger)
+#   DECODER_LOG_FORMAT   - text (default) or json (one object per line)
+#   DECODER_LOG_READINGS - sample (default: one line per device per DECODER_LOG_SAMPLE
+#                          seconds), all (every reading, the old behaviour) or off
+#   DECODER_LOG_QUEUE    - max pending log lines; beyond it lines are dropped, not waited on
+#   DEBUG_DECODER        - any value enables per-message debug lines (read once at startup)
+LOG_FORMAT = os.getenv("DECODER_LOG_FORMAT", "text").lower()
+LOG_READINGS = os.getenv("DECODER_LOG_READINGS", "sample").lower()
+LOG_SAMPLE = float(os.getenv("DECODER_LOG_SAMPLE", "300"))
+LOG_QUEUE = int(os.getenv("DECODER_LOG_QUEUE", "10000"))
+DEBUG = bool(os.getenv("DEBUG_DECODER"))
+
+# HTTP metrics endpoint: /metrics (Prometheus text) and /metrics.json
+#   DECODER_METRICS_PORT - listen port (0 = off)
+#   DECODER_METRICS_BIND - listen address (default 127.0.0.1; 0.0.0.0 for all interfaces)
+METRICS_PORT = int(os.getenv("DECODER_METRICS_PORT", "0"))
+METRICS_BIND = os.getenv("DECODER_METRICS_BIND", "127.0.0.1")
+
+# On-demand profiling: SIGUSR1 (docker kill -s USR1 ble-decoder) or
+# POST /profile?seconds=N on the metrics port; reports go to STATE_DIR/profiles
+#   DECODER_PROFILE_SECONDS - capture length for SIGUSR1 (default 30)
+#   DECODER_PROFILE_HTTP    - 1 enables POST /profile (off: anyone who can reach
+#                             the metrics port could otherwise start captures)
+PROFILE_SECONDS = float(os.getenv("DECODER_PROFILE_SECONDS", "30"))
+PROFILE_HTTP = os.getenv("DECODER_PROFILE_HTTP", "0").lower() in ("1", "true", "yes", "on")
+
+# JSON library for gateway payloads and JSON output
+#   DECODER_JSON - auto (orjson if installed, else stdlib), orjson or stdlib
+JSON_BACKEND = os.getenv("DECODER_JSON", "auto").lower()
+if JSON_BACKEND == "auto":
+    JSON_BACKEND = "orjson" if orjson is not None else "stdlib"
+
+# Output sink
+#   DECODER_SINK - mqtt (publish for Telegraf, default) or influx (write line protocol
+#                  straight to InfluxDB's v2 write API, skipping mosquitto and Telegraf)
+#   DECODER_INFLUX_* - connection and batching for the influx sink: lines per write,
+#                  max seconds between writes, max lines buffered while InfluxDB is down
+SINK = os.getenv("DECODER_SINK", "mqtt").lower()
+INFLUX_URL = os.getenv("DECODER_INFLUX_URL", "http://influxdb:8086")
+INFLUX_TOKEN = os.getenv("DECODER_INFLUX_TOKEN", "")
+INFLUX_ORG = os.getenv("DECODER_INFLUX_ORG", "home")
+INFLUX_BUCKET = os.getenv("DECODER_INFLUX_BUCKET", "sensors")
+INFLUX_BATCH = int(os.getenv("DECODER_INFLUX_BATCH", "5000"))
+INFLUX_FLUSH = float(os.getenv("DECODER_INFLUX_FLUSH", "1"))
+INFLUX_BUFFER = int(os.getenv("DECODER_INFLUX_BUFFER", "100000"))
+
+# Store-and-forward spool for output the sink can't take (broker down, InfluxDB down)
+#   DECODER_SPOOL_MAX_MB - disk cap; oldest segments are evicted past it (0 = disabled)
+#   DECODER_SPOOL_RATE   - records/s replayed once the sink is back
+SPOOL_MAX_MB = float(os.getenv("DECODER_SPOOL_MAX_MB", "256"))
+SPOOL_RATE = int(os.getenv("DECODER_SPOOL_RATE", "1000"))
+
+# Cross-gateway duplicate suppression (the same advert heard by several gateways)
+#   DECODER_DEDUP_WINDOW - seconds an advert is considered a duplicate (0 = off)
+#   DECODER_DEDUP_MODE   - first (publish the first copy immediately) or
+#                          strongest (hold for the window, publish the best-RSSI copy)
+#   DECODER_DEDUP_MAX    - max adverts tracked at once (bounds memory)
+DEDUP_WINDOW = float(os.getenv("DECODER_DEDUP_WINDOW", "0"))
+DEDUP_MODE = os.getenv("DECODER_DEDUP_MODE", "first").lower()
+DEDUP_MAX = int(os.getenv("DECODER_DEDUP_MAX", "4096"))
+
+# Deadband / heartbeat publishing (per source gateway + device, per metric)
+#   DECODER_DEADBAND  - "metric=threshold,..." e.g. "temperature=0.2,humidity=0.5,battery=1,rssi=5";
+#                       a metric is only republished once it moves by at least its threshold
+#                       (metrics not listed always publish; empty = filter off)
+#   DECODER_HEARTBEAT - seconds after which an unchanged metric is republished anyway
+DEADBAND = os.getenv("DECODER_DEADBAND", "")
+HEARTBEAT = float(os.getenv("DECODER_HEARTBEAT", "300"))
+
+# Edge aggregation: publish one summary per device per tumbling window instead of
+# every reading (mean as the plain metric plus _min/_max, last battery, sample count)
+#   DECODER_AGGREGATE_WINDOW - window length in seconds, aligned to the clock (0 = off)
+AGGREGATE_WINDOW = float(os.getenv("DECODER_AGGREGATE_WINDOW", "0"))
+
+# Decode worker pool between paho's network thread and the decode pipeline
+#   DECODER_WORKERS   - decode threads (0 = decode inline on the network thread)
+#   DECODER_QUEUE_MAX - max queued messages per worker
+#   DECODER_OVERFLOW  - drop-oldest (discard the stalest queued message) or
+#                       block (stall the network thread, pushing back on the broker)
+WORKERS = int(os.getenv("DECODER_WORKERS", "1"))
+QUEUE_MAX = int(os.getenv("DECODER_QUEUE_MAX", "10000"))
+OVERFLOW = os.getenv("DECODER_OVERFLOW", "drop-oldest").lower()
+
+# Horizontal scaling across decoder instances
+#   DECODER_SHARD_MODE  - none (single instance), hash (every instance subscribes to
+#                         everything and keeps MACs where crc32(mac) % COUNT == INDEX), or
+#                         shared (MQTT $share/ subscription, broker load-balances messages)
+#   DECODER_SHARD_COUNT / DECODER_SHARD_INDEX - hash mode: total instances and this one (0-based)
+#   DECODER_SHARE_GROUP - shared mode: subscription group name
+#   DECODER_CLIENT_ID   - MQTT client id (default: dpx_ops_decoder, made unique per shard)
+# --replica on the command line marks an extra identical copy (compose service
+# ble-decoder-shard, scaled with --scale); replicas only start in shared mode
+SHARD_MODE = os.getenv("DECODER_SHARD_MODE", "none").lower()
+SHARD_COUNT = int(os.getenv("DECODER_SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("DECODER_SHARD_INDEX", "0"))
+SHARE_GROUP = os.getenv("DECODER_SHARE_GROUP", DECODER_NODE)
+if SHARD_MODE == "hash":
+    DEFAULT_CLIENT_ID = f"{DECODER_NODE}_{SHARD_INDEX}"
+elif SHARD_MODE == "shared":
+    # Replicas share one env; pid keeps two processes on one host apart
+    DEFAULT_CLIENT_ID = f"{DECODER_NODE}_{socket.gethostname()}_{os.getpid()}"
+else:
+    DEFAULT_CLIENT_ID = DECODER_NODE
+CLIENT_ID = os.getenv("DECODER_CLIENT_ID", DEFAULT_CLIENT_ID)
+REPLICA = "--replica" in sys.argv[1:]
+
 # Subscribe to both gateway types
 SUB_TOPICS = [
     f"{SHOWSITE}/+/BTtoMQTT/#",        # ESP32 gateways
     "home/TheengsGateway/BTtoMQTT/#",  # Theengs gateway
 ]
 
-# Decoder configuration per model
-DECODERS = {
-    "H5051": lambda b: decode_h5051(b),
-    "H5074": lambda b: decode_h507x(b),
-    "H5075": lambda b: decode_h5075(b),
-    "H5072": lambda b: decode_h507x(b),
+# Decoder layout per model, compiled into DECODERS at startup (see compile_decoder).
+#   header     - hex prefix the manufacturer data must start with
+#   min_len    - shortest accepted payload in bytes
+#   fields     - output key -> offset, struct type ("B", "<H", ">h"...), then optional
+#                add (before dividing), divide, fahrenheit (value is °C), clamp [lo, hi]
+# Extra or replacement models can be added without code in decoder-specs.json
+# (same format, next to device-overrides.json).
+H507X_SPEC = {  # little-endian 16-bit values in hundredths
+    "header": "88ec",
+    "min_len": 8,
+    "fields": {
+        "temp_f": {"offset": 3, "type": "<H", "divide": 100, "fahrenheit": True},
+        "humidity": {"offset": 5, "type": "<H", "divide": 100},
+        "battery": {"offset": 7, "type": "B"},
+    },
 }
+DECODER_SPECS = {
+    "H5051": {
+        "min_len": 8,
+        "fields": {
+            "temp_f": {"offset": 3, "type": "<H", "divide": 100, "fahrenheit": True},
+            "humidity": {"offset": 5, "type": "B", "divide": 10},
+            "battery": {"offset": 7, "type": "B"},
+        },
+    },
+    "H5074": H507X_SPEC,
+    "H5072": H507X_SPEC,
+    "H5075": {
+        "header": "88ec",
+        "min_len": 7,
+        "fields": {
+            # BIG-endian, empirical formula derived from sample data: tempC = (raw + 16) / 40
+            "temp_f": {"offset": 3, "type": ">H", "add": 16, "divide": 40, "fahrenheit": True},
+            # Empirical approximation (refined formula TBD with more varying samples)
+            "humidity": {"offset": 5, "type": "B", "add": -135, "divide": 2.5, "clamp": [0, 100]},
+            "battery": {"offset": 6, "type": "B"},
+        },
+    },
+}
+# Raw-decode result cache: sensors re-advertise unchanged readings, so the same
+# manufacturerdata hex repeats constantly
+#   DECODER_DECODE_CACHE - LRU entries per model (0 = off)
+DECODE_CACHE_SIZE = int(os.getenv("DECODER_DECODE_CACHE", "4096"))
+DECODER_SPECS_FILE = os.path.join(os.path.dirname(__file__), "telegraf", "conf.d", "decoder-specs.json")
+
+# How often to print the message counter summary (seconds, 0 = never)
+STATS_INTERVAL = int(os.getenv("DECODER_STATS_INTERVAL", "60"))
 
 # Device mapping loaded from API
 DEVICES = {}
 
+# Local state (device-map snapshot etc.); mounted as a volume in the container
+STATE_DIR = os.getenv("DECODER_STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+SNAPSHOT_FILE = os.path.join(STATE_DIR, "device-snapshot.json")
+SPOOL_DIR = os.path.join(STATE_DIR, "spool")
+PROFILE_DIR = os.path.join(STATE_DIR, "profiles")
+# Last successful API result (before overrides) and when it was fetched (0 = never)
+API_DEVICES = None
+DEVICES_FETCHED_AT = 0.0
+
+# Local name/room overrides (mounted read-only in the container)
+OVERRIDE_FILE = os.path.join(os.path.dirname(__file__), "telegraf", "conf.d", "device-overrides.json")
+
+# In-process device map refresh (no container restart needed)
+#   DECODER_REFRESH_INTERVAL - seconds between API re-polls (0 = only at startup)
+# device-overrides.json is watched by mtime and re-applied as soon as it changes;
+# SIGHUP forces an immediate API refresh.
+REFRESH_INTERVAL = float(os.getenv("DECODER_REFRESH_INTERVAL", "900"))
+RELOAD_LOCK = threading.Lock()
+
+# Event-driven registry (device_registry.py): when set, its retained snapshot on this
+# topic replaces API polling as the source of device names/rooms/SKUs
+REGISTRY_TOPIC = os.getenv("DECODER_REGISTRY_TOPIC", "")
+# A registry table with fewer than this fraction of the current device count is
+# refused (a registry that lost govee2mqtt must not wipe the map); 0 = accept all
+REGISTRY_MIN_FRACTION = float(os.getenv("DECODER_REGISTRY_MIN_FRACTION", "0.5"))
+
+
+class Counters:
+    """
+    Message counters that any thread can bump without taking a lock.
+
+    Each thread increments its own dict (created on first use); snapshot()
+    sums them. Keys are fixed up front so the dicts never resize while read.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.local = threading.local()
+        self.shards = []
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        """This thread's counter dict."""
+        try:
+            return self.local.counts
+        except AttributeError:
+            counts = dict.fromkeys(self.names, 0)
+            with self.lock:
+                self.shards.append(counts)
+            self.local.counts = counts
+            return counts
+
+    def inc(self, name, amount=1):
+        self.shard()[name] += amount
+
+    def add_source(self, source):
+        """Also add source() ({name: count}) into every snapshot, for counts kept elsewhere."""
+        with self.lock:
+            self.sources.append(source)
+
+    def snapshot(self):
+        """Totals across all threads."""
+        with self.lock:
+            shards = list(self.shards)
+            sources = list(self.sources)
+        totals = dict.fromkeys(self.names, 0)
+        for counts in shards:
+            for name, value in counts.items():
+                totals[name] += value
+        for source in sources:
+            for name, value in source().items():
+                totals[name] += value
+        return totals
+
+
+# Message counters, updated along the pipeline and reported by log_stats()
+STATS = Counters([
+    "received",
+    "dropped_shard",       # MAC belongs to another hash shard
+    "dropped_unknown",     # unknown MAC, discarded from the topic alone
+    "dropped_no_data",     # known device but nothing decodable in the payload
+    "decoded",
+    "decode_cache_hits",   # raw decodes answered from DecodeCache (from cache_info())
+    "decode_cache_misses", # raw decodes that ran the decoder (from cache_info())
+    "duplicates",          # copies collapsed by the dedup window
+    "published",           # readings handed to the output
+    "metrics_in",          # metric values seen by the deadband filter
+    "metrics_suppressed",  # ... of which unchanged and not due for a heartbeat
+    "queue_dropped",       # discarded by the drop-oldest overflow policy
+    "processed",           # messages taken off the work queue
+    "influx_lines",        # lines accepted by InfluxDB
+    "influx_batches",      # successful write requests
+    "influx_retries",      # failed write attempts that will be retried
+    "influx_dropped",      # lines lost to a full buffer or a rejected batch
+    "spooled",             # output records written to the disk spool
+    "spool_replayed",      # spooled records handed back to the sink
+    "spool_evicted",       # spooled records lost to the size cap
+    "latency_sum",         # seconds from enqueue to processed, summed
+    "errors",
+    "publish_errors",      # MQTT publishes paho refused (not connected, queue full...)
+    "log_dropped",         # log lines discarded because the writer fell behind
+])
+_stats_previous = {}
+
+
+class KeyedCounters(Counters):
+    """Counters whose names appear at runtime (one per gateway), same per-thread scheme."""
+
+    def __init__(self):
+        super().__init__(())
+
+    def inc(self, name, amount=1):
+        counts = self.shard()
+        counts[name] = counts.get(name, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            shards = list(self.shards)
+        totals = {}
+        for counts in shards:
+            for name, value in dict(counts).items():  # copy: other threads may add keys
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+# Decoded readings per source node (gateway), for the per-gateway rate line
+GATEWAY_STATS = KeyedCounters()
+_gateway_previous = {}
+# Raw decodes that failed (no decoder, or the decoder rejected the packet) per SKU
+DECODE_FAILURES = KeyedCounters()
+
+
+class Histogram:
+    """
+    Bucketed observations (seconds) with the same per-thread, lock-free
+    increments as Counters; buckets are cumulative only when read.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counters = Counters(list(range(len(self.bounds) + 1)) + ["sum"])
+
+    def observe(self, value):
+        counts = self.counters.shard()
+        counts[bisect_left(self.bounds, value)] += 1  # bucket i: value <= bounds[i]
+        counts["sum"] += value
+
+    def snapshot(self):
+        """(cumulative count per bound, total count, sum)."""
+        totals = self.counters.snapshot()
+        cumulative, running = [], 0
+        for i in range(len(self.bounds)):
+            running += totals[i]
+            cumulative.append(running)
+        return cumulative, running + totals[len(self.bounds)], totals["sum"]
+
+
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+# Wall time of process_message (parse, lookup, decode, publish) per message
+PROCESS_TIME = Histogram(LATENCY_BOUNDS)
+# Time a message waited in a worker queue before processing (only with workers)
+QUEUE_WAIT = Histogram(LATENCY_BOUNDS)
+
+
+class Logger:
+    """
+    Non-blocking structured log writer.
+
+    log() only timestamps the record and puts it on a bounded queue; a
+    background thread renders text or JSON lines and writes them to stdout
+    in batches. If the writer falls behind (slow terminal, Docker's json-file
+    driver) records are dropped and counted rather than stalling decoding.
+    A record's text is either a ready string or a function of its fields,
+    rendered only in text mode.
+    """
 
-def load_devices():
-    """Load device info from govee2mqtt API and apply local overrides."""
+    LEVELS = {"debug": "DEBUG ", "info": "", "warning": "WARNING ", "error": "ERROR "}
+    BATCH = 256
+
+    def __init__(self, fmt, max_queue):
+        self.json = fmt == "json"
+        self.queue = queue.Queue(max_queue)
+        self.next_allowed = {}
+        threading.Thread(target=self.run, name="log-writer", daemon=True).start()
+
+    def log(self, level, event, text, **fields):
+        try:
+            self.queue.put_nowait((time.time(), level, event, text, fields))
+        except queue.Full:
+            STATS.inc("log_dropped")
+
+    def info(self, event, text, **fields):
+        self.log("info", event, text, **fields)
+
+    def warning(self, event, text, **fields):
+        self.log("warning", event, text, **fields)
+
+    def debug(self, event, text, **fields):
+        self.log("debug", event, text, **fields)
+
+    def allow(self, key, interval, now):
+        """Rate limit: True at most once per `interval` seconds for `key`."""
+        if now < self.next_allowed.get(key, 0.0):
+            return False
+        self.next_allowed[key] = now + interval
+        return True
+
+    def render(self, record):
+        ts, level, event, text, fields = record
+        if self.json:
+            line = {"time": datetime.fromtimestamp(ts).isoformat(timespec="milliseconds"),
+                    "level": level, "event": event}
+            line.update(fields)
+            if isinstance(text, str):
+                line["msg"] = text
+            return json.dumps(line, separators=(",", ":"), default=str)
+        if not isinstance(text, str):
+            text = text(fields)
+        return f"{datetime.fromtimestamp(ts).strftime('%H:%M:%S')} {self.LEVELS[level]}{text}"
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.BATCH:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for record in records:
+                try:
+                    lines.append(self.render(record))
+                except Exception as e:
+                    lines.append(f"log render error in {record[2]}: {e}")
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+            for _ in records:
+                self.queue.task_done()
+
+    def flush(self, timeout=2.0):
+        """Wait (bounded) for queued lines to be written, e.g. on shutdown."""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+def render_reading(fields):
+    """Text line for one published reading (same layout the decoder always printed)."""
+    values = []
+    if "temperature" in fields:
+        values.append(f"{fields['temperature']:.2f}°F")
+    if "humidity" in fields:
+        values.append(f"{fields['humidity']:.1f}%")
+    values.append(f"batt: {fields.get('battery', '?')}%")
+    if "count" in fields:
+        values.append(f"n={fields['count']}")
+    return f"[{fields['source_node']}] {fields['room']}/{fields['device']}: " + ", ".join(values)
+
+
+LOG = Logger(LOG_FORMAT, LOG_QUEUE)
+_stats_last_report = time.monotonic()
+_next_api_refresh = time.monotonic() + REFRESH_INTERVAL
+_override_mtime = None
+
+# Main-thread housekeeping period (seconds); bounds extra latency of held readings
+HOUSEKEEPING_TICK = 0.25
+_spool_last_drain = time.monotonic()
+
+
+class DeviceIndex:
+    """
+    Precomputed MAC-suffix lookup over a DEVICES-style map.
+
+    Keeps the matching rule of the old linear scan (incoming MAC and registered
+    suffix match when either ends with the other, first registered device wins)
+    but answers full MACs with one dict probe per distinct key length, so cost
+    no longer grows with fleet size. Partial MACs shorter than a registered key
+    take a memoized scan, which only happens for malformed/partial IDs.
+    """
+
+    PARTIAL_CACHE_MAX = 4096
+
+    def __init__(self, devices):
+        self.devices = devices
+        # suffix -> (registration order, info); order breaks ties like the scan did
+        self.exact = {suffix: (rank, info) for rank, (suffix, info) in enumerate(devices.items())}
+        self.lengths = sorted({len(suffix) for suffix in devices})
+        self.max_length = self.lengths[-1] if self.lengths else 0
+        self.partial = {}
+
+    def __len__(self):
+        return len(self.exact)
+
+    def lookup(self, mac):
+        """Return device info for a normalized MAC, or None if unregistered."""
+        if not mac:
+            return None
+        n = len(mac)
+        if n >= self.max_length and len(self.lengths) == 1:
+            # Common case: every key is 12 chars and so is the incoming MAC
+            hit = self.exact.get(mac if n == self.max_length else mac[-self.max_length:])
+            return hit[1] if hit else None
+
+        best = None
+        for length in self.lengths:
+            if length > n:
+                break
+            hit = self.exact.get(mac[-length:])
+            if hit and (best is None or hit[0] < best[0]):
+                best = hit
+        if n < self.max_length:
+            hit = self._partial_lookup(mac)
+            if hit and (best is None or hit[0] < best[0]):
+                best = hit
+        return best[1] if best else None
+
+    def _partial_lookup(self, mac):
+        """Find the first key longer than mac that ends with it (memoized)."""
+        try:
+            return self.partial[mac]
+        except KeyError:
+            pass
+        hit = None
+        for suffix, entry in self.exact.items():
+            if len(suffix) > len(mac) and suffix.endswith(mac):
+                hit = entry
+                break
+        if len(self.partial) >= self.PARTIAL_CACHE_MAX:
+            self.partial.clear()
+        self.partial[mac] = hit
+        return hit
+
+
+# Lookup index over DEVICES; replaced wholesale by load_devices()
+DEVICE_INDEX = DeviceIndex(DEVICES)
+
+
+def fetch_api_devices():
+    """Fetch devices from the govee2mqtt API as a suffix -> info map, or None on failure."""
     try:
         resp = urllib.request.urlopen(API, timeout=5)
-        devices = json.loads(resp.read())
-        for d in devices:
+        api_devices = json.loads(resp.read())
+        devices = {}
+        for d in api_devices:
             mac = d["id"].replace(":", "").upper()
             suffix = mac[-12:]
-            DEVICES[suffix] = {
+            devices[suffix] = {
                 "name": d["name"].lower().replace(" ", "_"),
                 "room": (d.get("room") or "unassigned").lower().replace(" ", "_"),
                 "sku": d["sku"],
                 "has_override": False  # Track if this device has an override
             }
-        print(f"Loaded {len(DEVICES)} devices from API")
+        LOG.info("devices", f"Loaded {len(devices)} devices from API", source="api", devices=len(devices))
+        return devices
     except Exception as e:
-        print(f"Failed to load devices: {e}")
-        print("Continuing with empty device map...")
-    
-    # Apply local overrides
-    override_file = os.path.join(os.path.dirname(__file__), "telegraf", "conf.d", "device-overrides.json")
-    print(f"DEBUG: Looking for override file at: {override_file}")
-    print(f"DEBUG: File exists: {os.path.exists(override_file)}")
-    if os.path.exists(override_file):
-        try:
-            with open(override_file) as f:
-                overrides = json.load(f)
-            print(f"DEBUG: Loaded override data: {overrides}")
-            override_count = 0
-            for mac_full, override_data in overrides.items():
-                if mac_full.startswith("_"):  # Skip JSON comments
-                    continue
-                mac_suffix = mac_full[-12:].upper()  # Match by suffix like API devices
-                if mac_suffix in DEVICES:
-                    # Update existing device
-                    if "name" in override_data:
-                        DEVICES[mac_suffix]["name"] = override_data["name"]
-                    if "room" in override_data:
-                        DEVICES[mac_suffix]["room"] = override_data["room"]
-                    if "sku" in override_data:
-                        DEVICES[mac_suffix]["sku"] = override_data["sku"]
-                    DEVICES[mac_suffix]["has_override"] = True
-                    override_count += 1
-                elif "name" in override_data:
-                    # Add override-only device (not in API)
-                    DEVICES[mac_suffix] = {
-                        "name": override_data["name"],
-                        "room": override_data.get("room", "unassigned"),
-                        "sku": override_data.get("sku", "unknown"),
-                        "has_override": True
-                    }
-                    override_count += 1
-            if override_count > 0:
-                print(f"Applied {override_count} device override(s)")
-        except Exception as e:
-            print(f"Warning: Failed to load overrides: {e}")
-    
-    # Print final device list
-    if DEVICES:
-        print("Final device mappings:")
-        for mac, info in DEVICES.items():
+        LOG.warning("devices", f"Failed to load devices: {e}", source="api", error=str(e))
+        return None
+
+
+def apply_overrides(devices):
+    """Apply device-overrides.json to a device map in place."""
+    if not os.path.exists(OVERRIDE_FILE):
+        return
+    try:
+        with open(OVERRIDE_FILE) as f:
+            overrides = json.load(f)
+        override_count = 0
+        for mac_full, override_data in overrides.items():
+            if mac_full.startswith("_"):  # Skip JSON comments
+                continue
+            mac_suffix = mac_full[-12:].upper()  # Match by suffix like API devices
+            if mac_suffix in devices:
+                # Update existing device
+                if "name" in override_data:
+                    devices[mac_suffix]["name"] = override_data["name"]
+                if "room" in override_data:
+                    devices[mac_suffix]["room"] = override_data["room"]
+                if "sku" in override_data:
+                    devices[mac_suffix]["sku"] = override_data["sku"]
+                devices[mac_suffix]["has_override"] = True
+                override_count += 1
+            elif "name" in override_data:
+                # Add override-only device (not in API)
+                devices[mac_suffix] = {
+                    "name": override_data["name"],
+                    "room": override_data.get("room", "unassigned"),
+                    "sku": override_data.get("sku", "unknown"),
+                    "has_override": True
+                }
+                override_count += 1
+        if override_count > 0:
+            LOG.info("overrides", f"Applied {override_count} device override(s)", overrides=override_count)
+    except Exception as e:
+        LOG.warning("overrides", f"Failed to load overrides: {e}", path=OVERRIDE_FILE, error=str(e))
+
+
+def load_devices(refresh_api=True):
+    """
+    Load device info from govee2mqtt API and apply local overrides.
+
+    The API result is kept (and saved as the startup snapshot) separately from
+    the overrides, so an override edit can be re-applied without the API and a
+    failed fetch falls back to the last good API data instead of an empty map.
+    Returns True if the API was refreshed.
+    """
+    global API_DEVICES, DEVICES_FETCHED_AT
+    fetched = fetch_api_devices() if refresh_api else None
+    if fetched is not None:
+        API_DEVICES = fetched
+        DEVICES_FETCHED_AT = time.time()
+        save_snapshot(fetched, DEVICES_FETCHED_AT)
+    elif refresh_api:
+        if API_DEVICES:
+            LOG.warning("devices", f"Keeping last API data for {len(API_DEVICES)} devices...",
+                        devices=len(API_DEVICES))
+        else:
+            LOG.warning("devices", "Continuing with empty device map...", devices=0)
+
+    # Build into a fresh map and swap at the end so readers never see a partial one
+    devices = {mac: dict(info) for mac, info in (API_DEVICES or {}).items()}
+    apply_overrides(devices)
+    install_devices(devices)
+    return fetched is not None
+
+
+def install_devices(devices):
+    """Swap in a new device map and its index, logging what changed."""
+    global DEVICES, DEVICE_INDEX, OUTPUT_CACHE
+    old = DEVICES
+    # Single rebinding each, no locking needed; on_message only reads DEVICE_INDEX
+    DEVICE_INDEX = DeviceIndex(devices)
+    DEVICES = devices
+    OUTPUT_CACHE = OutputCache()  # Topics embed room/name
+
+    if old:
+        changes = describe_device_changes(old, devices)
+        if changes:
+            LOG.info("devices", f"Device map updated ({len(devices)} devices):", devices=len(devices))
+            for line in changes:
+                LOG.info("device_change", f"  {line}", change=line)
+        return
+
+    # Log final device list
+    if devices:
+        LOG.info("devices", "Final device mappings:", devices=len(devices))
+        for mac, info in devices.items():
             override_marker = " [OVERRIDE]" if info.get("has_override") else ""
-            print(f"  {mac} -> {info['name']} ({info['sku']}) in {info['room']}{override_marker}")
+            LOG.info("device", f"  {mac} -> {info['name']} ({info['sku']}) in {info['room']}{override_marker}",
+                     mac=mac, name=info["name"], sku=info["sku"], room=info["room"],
+                     override=bool(info.get("has_override")))
 
 
-def decode_h5051(b):
-    """Decode Govee H5051 manufacturer data."""
-    if len(b) < 8:
-        return None
-    temp_raw = b[3] | (b[4] << 8)
-    return {
-        "temp_f": (temp_raw / 100.0) * 9.0 / 5.0 + 32.0,  # Fahrenheit
-        "humidity": b[5] / 10.0,
-        "battery": b[7]
-    }
+def describe_device_changes(old, new):
+    """One line per added, removed or changed device between two maps."""
+    lines = []
+    for mac, info in new.items():
+        before = old.get(mac)
+        if before is None:
+            lines.append(f"+ {mac} -> {info['name']} ({info['sku']}) in {info['room']}")
+        elif (before["name"], before["room"], before["sku"]) != (info["name"], info["room"], info["sku"]):
+            lines.append(
+                f"~ {mac}: {before['name']} ({before['sku']}) in {before['room']} -> "
+                f"{info['name']} ({info['sku']}) in {info['room']}"
+            )
+    for mac, info in old.items():
+        if mac not in new:
+            lines.append(f"- {mac} ({info['name']})")
+    return lines
 
 
-def decode_h507x(b):
-    """Decode Govee H5074/H5072 manufacturer data (little-endian)."""
-    if len(b) < 8:
-        return None
-    # Reject iBeacon packets (start with 4c00) and other non-Govee packets
-    if b[0] == 0x4c:  # Apple iBeacon
-        return None
-    # Validate Govee manufacturer header (88ec or 0188ec)
-    if not (b[0] == 0x88 and b[1] == 0xec):
+def override_mtime():
+    """Modification time of device-overrides.json (None if absent)."""
+    try:
+        return os.stat(OVERRIDE_FILE).st_mtime
+    except OSError:
         return None
-    # Little-endian 16-bit values in hundredths
-    temp_raw = b[3] | (b[4] << 8)
-    hum_raw = b[5] | (b[6] << 8)
-    return {
-        "temp_f": (temp_raw / 100.0) * 9.0 / 5.0 + 32.0,  # Fahrenheit
-        "humidity": hum_raw / 100.0,
-        "battery": b[7] if len(b) > 7 else 100
+
+
+def request_reload(refresh_api, reason):
+    """
+    Reload the device map on a background thread (API fetches can take seconds).
+    Returns False if a reload is already running.
+    """
+    if not RELOAD_LOCK.acquire(blocking=False):
+        return False
+    refresh_api = refresh_api and not REGISTRY_TOPIC  # registry pushes updates instead
+
+    def run():
+        try:
+            LOG.info("reload", f"Reloading devices ({reason})", reason=reason, refresh_api=refresh_api)
+            load_devices(refresh_api)
+        finally:
+            RELOAD_LOCK.release()
+
+    threading.Thread(target=run, name="device-reload", daemon=True).start()
+    return True
+
+
+def on_registry(client, userdata, msg):
+    """Install a device table published by device_registry.py (retained message)."""
+    global API_DEVICES, DEVICES_FETCHED_AT
+    try:
+        registry = json.loads(msg.payload)
+        api_devices = {
+            mac: {"name": name, "room": room, "sku": sku, "has_override": False}
+            for mac, (name, room, sku) in registry["devices"].items()
+        }
+    except Exception as e:
+        LOG.warning("registry", f"Ignoring malformed registry message on {msg.topic}: {e}",
+                    topic=msg.topic, error=str(e))
+        return
+    with RELOAD_LOCK:
+        current = len(API_DEVICES or {})
+        if current and len(api_devices) < current * REGISTRY_MIN_FRACTION:
+            LOG.warning("registry",
+                        f"Refusing registry update with {len(api_devices)} devices "
+                        f"(have {current}; DECODER_REGISTRY_MIN_FRACTION={REGISTRY_MIN_FRACTION:g})",
+                        devices=len(api_devices), current=current)
+            return
+        API_DEVICES = api_devices
+        DEVICES_FETCHED_AT = registry.get("updated_at") or time.time()
+        save_snapshot(api_devices, DEVICES_FETCHED_AT)
+        LOG.info("registry", f"Registry update: {len(api_devices)} devices", devices=len(api_devices))
+        load_devices(refresh_api=False)
+
+
+def save_snapshot(devices, fetched_at):
+    """Persist the API device map for the next startup (atomic replace)."""
+    snapshot = {
+        "fetched_at": fetched_at,
+        "devices": {mac: [info["name"], info["room"], info["sku"]] for mac, info in devices.items()},
     }
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        temp_path = f"{SNAPSHOT_FILE}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(temp_path, SNAPSHOT_FILE)
+    except Exception as e:
+        LOG.warning("snapshot", f"Failed to save device snapshot: {e}", path=SNAPSHOT_FILE, error=str(e))
 
 
-def decode_h5075(b):
-    """Decode Govee H5075 manufacturer data (big-endian, different encoding)."""
-    if len(b) < 7:
-        return None
-    # Reject iBeacon packets
-    if b[0] == 0x4c:
-        return None
-    # Validate Govee manufacturer header
-    if not (b[0] == 0x88 and b[1] == 0xec):
-        return None
-    
-    # Temperature: bytes 3-4, BIG-endian (different from H5074!)
-    # Empirical formula derived from sample data: tempC = (raw + 16) / 40
-    temp_raw = (b[3] << 8) | b[4]
-    temp_c = (temp_raw + 16) / 40.0
-    temp_f = temp_c * 9.0 / 5.0 + 32.0
-    
-    # Humidity: byte 5
-    # Empirical approximation (refined formula TBD with more varying samples)
-    humidity = (b[5] - 135) / 2.5
-    
+def load_snapshot():
+    """Install the device map from the last successful API fetch; True if one was found."""
+    global API_DEVICES, DEVICES_FETCHED_AT
+    try:
+        with open(SNAPSHOT_FILE) as f:
+            snapshot = json.load(f)
+        api_devices = {
+            mac: {"name": name, "room": room, "sku": sku, "has_override": False}
+            for mac, (name, room, sku) in snapshot["devices"].items()
+        }
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        LOG.warning("snapshot", f"Ignoring unreadable device snapshot: {e}", path=SNAPSHOT_FILE, error=str(e))
+        return False
+    API_DEVICES = api_devices
+    DEVICES_FETCHED_AT = snapshot.get("fetched_at", 0.0)
+    age = time.time() - DEVICES_FETCHED_AT
+    LOG.info("devices", f"Loaded {len(api_devices)} devices from snapshot ({age:.0f}s old)",
+             source="snapshot", devices=len(api_devices), age_seconds=round(age))
+    load_devices(refresh_api=False)
+    return True
+
+
+def devices_age():
+    """Seconds since the installed device map was fetched from the API (None if never)."""
+    return time.time() - DEVICES_FETCHED_AT if DEVICES_FETCHED_AT else None
+
+
+def compile_decoder(sku, spec):
+    """
+    Build a decoder function for one DECODER_SPECS entry.
+
+    All fields are read with one precompiled struct.Struct (gaps padded), and
+    the conversions are generated as a single return expression, so a decode
+    costs one unpack_from plus the arithmetic a hand-written decoder would do.
+    Raises ValueError for overlapping fields or mixed multi-byte endianness.
+    """
+    fields = sorted(spec["fields"].items(), key=lambda item: item[1]["offset"])
+    order = {f["type"][0] for _, f in fields if f["type"][0] in "<>"}
+    if len(order) > 1:
+        raise ValueError(f"{sku}: mixed endianness in one layout")
+    layout, position = order.pop() if order else "<", 0
+    names = []
+    for name, field in fields:
+        if field["offset"] < position:
+            raise ValueError(f"{sku}: field {name} overlaps the previous one")
+        layout += "x" * (field["offset"] - position) + field["type"].lstrip("<>")
+        position = field["offset"] + struct.calcsize("<" + field["type"].lstrip("<>"))
+        names.append(name)
+    layout = struct.Struct(layout)
+
+    outputs = []
+    for name, field in spec["fields"].items():
+        expr = f"v{names.index(name)}"
+        if field.get("add"):
+            expr = f"({expr} + {field['add']!r})"
+        if field.get("divide"):
+            expr = f"{expr} / {float(field['divide'])!r}"
+        if field.get("fahrenheit"):
+            expr = f"{expr} * 9.0 / 5.0 + 32.0"
+        if field.get("clamp"):
+            low, high = field["clamp"]
+            expr = f"max({low!r}, min({high!r}, {expr}))"
+        outputs.append(f"{name!r}: {expr}")
+
+    # Header bytes are compared as int literals (cheaper than a slice or startswith)
+    min_len = max(spec.get("min_len", 0), layout.size, len(bytes.fromhex(spec.get("header", ""))))
+    checks = [f"len(b) < {min_len}"]
+    checks += [f"b[{i}] != {byte}" for i, byte in enumerate(bytes.fromhex(spec.get("header", "")))]
+    unpacked = "".join(f"v{i}, " for i in range(len(names)))
+    source = (
+        f"def decode(b, _unpack=_layout.unpack_from):\n"
+        f"    if {' or '.join(checks)}:\n"
+        f"        return None\n"
+        f"    {unpacked}= _unpack(b)\n"
+        f"    return {{{', '.join(outputs)}}}\n"
+    )
+    namespace = {"_layout": layout}
+    exec(compile(source, f"<decoder {sku}>", "exec"), namespace)
+    decode = namespace["decode"]
+    decode.__doc__ = f"Decode {sku} manufacturer data (compiled from DECODER_SPECS)."
+    return decode
+
+
+def load_decoder_specs():
+    """Built-in DECODER_SPECS updated with decoder-specs.json, if present."""
+    specs = dict(DECODER_SPECS)
+    if os.path.exists(DECODER_SPECS_FILE):
+        try:
+            with open(DECODER_SPECS_FILE) as f:
+                extra = {k: v for k, v in json.load(f).items() if not k.startswith("_")}
+            specs.update(extra)
+            LOG.info("decoder_specs", f"Loaded {len(extra)} decoder specs from {DECODER_SPECS_FILE}",
+                     path=DECODER_SPECS_FILE, specs=len(extra))
+        except Exception as e:
+            LOG.warning("decoder_specs", f"Failed to load decoder specs: {e}",
+                        path=DECODER_SPECS_FILE, error=str(e))
+    return specs
+
+
+def compile_decoders(specs):
+    """SKU -> compiled decoder; a broken spec is reported and skipped."""
+    decoders = {}
+    for sku, spec in specs.items():
+        try:
+            decoders[sku] = compile_decoder(sku, spec)
+        except (KeyError, TypeError, ValueError, struct.error) as e:
+            LOG.warning("decoder_specs", f"Skipping decoder spec {sku}: {e}", sku=sku, error=str(e))
+    return decoders
+
+
+# Decoder per model (SKU); process_message dispatches with one dict lookup
+ACTIVE_SPECS = load_decoder_specs()
+DECODERS = compile_decoders(ACTIVE_SPECS)
+
+
+class DecodeCache:
+    """
+    Bounded LRU of raw manufacturerdata hex -> decoded values for one model.
+
+    decode is a functools.lru_cache, so a hit is one C-level lookup with no
+    Python frame, lock or counter update; hits and misses are read back from
+    cache_info(). Results (None included, for packets that don't decode) are
+    shared between callers and must not be mutated.
+    """
+
+    def __init__(self, decoder, max_entries):
+        self.decoder = decoder
+        self.decode = functools.lru_cache(maxsize=max_entries)(self.decode_hex)
+
+    def __len__(self):
+        return self.decode.cache_info().currsize
+
+    def decode_hex(self, mfr):
+        return self.decoder(bytes.fromhex(mfr))
+
+
+# Per-model decode caches (empty when DECODER_DECODE_CACHE=0)
+DECODE_CACHES = {
+    sku: DecodeCache(decoder, DECODE_CACHE_SIZE) for sku, decoder in DECODERS.items()
+} if DECODE_CACHE_SIZE > 0 else {}
+
+
+def decode_cache_counts():
+    """Hit/miss totals across the decode caches, as STATS counter values."""
+    infos = [cache.decode.cache_info() for cache in DECODE_CACHES.values()]
     return {
-        "temp_f": temp_f,
-        "humidity": max(0, min(100, humidity)),  # Clamp to valid 0-100 range
-        "battery": b[6] if len(b) > 6 else 100
+        "decode_cache_hits": sum(info.hits for info in infos),
+        "decode_cache_misses": sum(info.misses for info in infos),
     }
 
 
+STATS.add_source(decode_cache_counts)
+
+
+def batch_dtype(spec, size):
+    """NumPy structured dtype reading a spec's fields from `size`-byte payloads."""
+    names, formats, offsets = [], [], []
+    for name, field in spec["fields"].items():
+        code = field["type"]
+        order = code[0] if code[0] in "<>" else "<"
+        kind = code[-1]
+        if kind not in "bBhHiIlLqQ":
+            raise ValueError(f"unsupported struct type {code!r} for batch decode")
+        names.append(name)
+        formats.append(f"{order}{'i' if kind.islower() else 'u'}{struct.calcsize('<' + kind)}")
+        offsets.append(field["offset"])
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": size})
+
+
+def batch_convert(raw, field):
+    """Column version of compile_decoder's conversion; same operations in the same order."""
+    values = raw.astype(np.int64)
+    if field.get("add"):
+        values = values + field["add"]
+    if field.get("divide"):
+        values = values / float(field["divide"])
+    if field.get("fahrenheit"):
+        values = values * 9.0 / 5.0 + 32.0
+    if field.get("clamp"):
+        low, high = field["clamp"]
+        values = np.maximum(low, np.minimum(high, values))
+    return values.astype(np.float64)
+
+
+def decode_batch(hex_payloads, skus):
+    """
+    Decode many manufacturer-data hex strings at once (bulk replay).
+
+    Payloads are grouped by SKU and byte length; each group is hex-decoded in
+    one bytes.fromhex call, viewed through a structured dtype built from the
+    model's DECODER_SPECS entry and converted column-wise. Returns float64
+    columns aligned with the input: "valid" (bool) plus one per decoded field,
+    NaN where a row didn't decode (unknown SKU, bad hex, too short, wrong
+    header). Valid rows equal what DECODERS[sku] returns for the same packet.
+    """
+    if np is None:
+        raise RuntimeError("decode_batch needs NumPy (pip install numpy)")
+    count = len(hex_payloads)
+    payloads = np.asarray(hex_payloads, dtype=object)
+    skus = np.asarray(skus, dtype=object)
+    lengths = np.fromiter(map(len, hex_payloads), dtype=np.int64, count=count)
+    columns = {"valid": np.zeros(count, dtype=bool)}
+
+    for sku in set(skus.tolist()):
+        spec = ACTIVE_SPECS.get(sku) if sku in DECODERS else None
+        if spec is None:
+            continue
+        header = bytes.fromhex(spec.get("header", ""))
+        min_size = max([spec.get("min_len", 0), len(header)] + [
+            field["offset"] + struct.calcsize("<" + field["type"][-1]) for field in spec["fields"].values()
+        ])
+        in_sku = np.flatnonzero(skus == sku)
+        for length in np.unique(lengths[in_sku]).tolist():
+            size = length // 2
+            if length % 2 or size < min_size:
+                continue
+            rows = in_sku[lengths[in_sku] == length]
+            dtype = batch_dtype(spec, size)
+            try:
+                buffer = bytes.fromhex("".join(payloads[rows].tolist()))
+                if len(buffer) != size * len(rows):
+                    raise ValueError("embedded whitespace")
+            except ValueError:
+                # Some rows aren't clean hex: keep only those that are
+                good, chunks = [], []
+                for row in rows.tolist():
+                    try:
+                        chunk = bytes.fromhex(payloads[row])
+                    except ValueError:
+                        continue
+                    if len(chunk) == size:
+                        good.append(row)
+                        chunks.append(chunk)
+                rows, buffer = np.asarray(good, dtype=np.int64), b"".join(chunks)
+                if not len(rows):
+                    continue
+
+            raw = np.frombuffer(buffer, dtype=np.uint8).reshape(len(rows), size)
+            ok = np.ones(len(rows), dtype=bool)
+            for i, byte in enumerate(header):
+                ok &= raw[:, i] == byte
+            rows = rows[ok]
+            records = np.frombuffer(buffer, dtype=dtype)[ok]
+            columns["valid"][rows] = True
+            for name, field in spec["fields"].items():
+                if name not in columns:
+                    columns[name] = np.full(count, np.nan)
+                columns[name][rows] = batch_convert(records[name], field)
+    return columns
+
+
 def extract_source_node(topic):
     """
     Extract source node name from incoming topic.
@@ -206,40 +1061,867 @@ def extract_source_node(topic):
         return "unknown"
 
 
-def on_message(client, userdata, msg):
-    """Process incoming BLE message and publish decoded data."""
-    try:
-        # Parse JSON payload first
-        data = json.loads(msg.payload)
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"))
 
-        # Extract MAC - either from topic or from payload (if extDecoderEnable=true)
-        topic_last = msg.topic.split("/")[-1]
-        if topic_last == "undecoded":
-            # extDecoderEnable mode: MAC is in the "id" field
-            mac = data.get("id", "").replace(":", "").upper()
+
+# name -> (loads, dumps); both accept/produce what paho hands over (bytes or str)
+JSON_BACKENDS = {"stdlib": (json.loads, stdlib_dumps)}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = (orjson.loads, orjson.dumps)  # JSONDecodeError subclasses json's
+if JSON_BACKEND not in JSON_BACKENDS:
+    LOG.warning("config", f"DECODER_JSON={JSON_BACKEND} unavailable, using stdlib json", json=JSON_BACKEND)
+    JSON_BACKEND = "stdlib"
+json_loads, json_dumps = JSON_BACKENDS[JSON_BACKEND]
+
+
+def topic_mac(topic):
+    """Normalized MAC from an incoming topic (None for undecoded topics)."""
+    topic_last = topic[topic.rfind("/") + 1:]
+    return None if topic_last == "undecoded" else topic_last.replace(":", "").upper()
+
+
+def parse_input_topic(topic):
+    """(MAC or None for undecoded topics, source_node) for an incoming topic."""
+    return topic_mac(topic), sys.intern(extract_source_node(topic))
+
+
+class TopicCache(dict):
+    """
+    Incoming topic -> (MAC, source_node), parsed once per topic.
+
+    Only topics from registered devices (plus one undecoded topic per
+    gateway) are added, so the size tracks fleet x gateways; the cap is a
+    guard against a misbehaving publisher.
+    """
+
+    MAX_ENTRIES = 65536
+
+    def __missing__(self, topic):
+        if len(self) >= self.MAX_ENTRIES:
+            self.clear()
+        info = self[topic] = parse_input_topic(topic)
+        return info
+
+
+class MetricStrings(dict):
+    """metric -> output string for one stream, built by `build` on first use and interned."""
+
+    def __init__(self, build):
+        super().__init__()
+        self.build = build
+
+    def __missing__(self, metric):
+        value = self[metric] = sys.intern(self.build(metric))
+        return value
+
+
+class OutputCache:
+    """
+    Output strings per (source_node, MAC): scalar metric topics, the JSON
+    topic and line-protocol heads, so publishing a reading only looks them up.
+
+    Room and name are baked into every string, so install_devices() replaces
+    the whole cache whenever the device map changes.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, source_node, device, mac):
+        key = (source_node, mac)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = self.build(source_node, device, mac)
+        return entry
+
+    @staticmethod
+    def build(source_node, device, mac):
+        """(scalar topics, JSON topic, line-protocol heads) for one stream."""
+        room, name = device["room"], device["name"]
+        base = f"{SHOWSITE}/{DECODER_NODE}/{source_node}/{room}/{name}/{mac}"
+        json_topic = sys.intern(f"{SHOWSITE}/{JSON_NODE}/{source_node}/{room}/{name}/{mac}")
+        tags = (f"{InfluxWriter.MEASUREMENT},device_name={escape_tag(name)},"
+                f"room={escape_tag(room)},sensor_type=")
+        source = f",source={DECODER_NODE},source_node={escape_tag(source_node)},topic={escape_tag(base)}/"
+        return (
+            MetricStrings(lambda metric: f"{base}/{metric}"),
+            json_topic,
+            MetricStrings(lambda metric: f"{tags}{metric}{source}{metric},z_device_id={mac} value="),
+        )
+
+
+TOPICS = TopicCache()
+OUTPUT_CACHE = OutputCache()
+
+
+class DedupWindow:
+    """
+    Time-windowed duplicate filter for adverts relayed by several gateways.
+
+    Entries are kept in arrival order in an OrderedDict, so expiry pops from
+    the front and the size cap evicts the oldest advert first. A reading is
+    (source_node, device, mac, fields, ts) - the publish_reading() arguments.
+    Windows run on `clock` (replay substitutes capture time).
+    """
+
+    def __init__(self, window, max_entries, keep_strongest, clock=time.monotonic):
+        self.window = window
+        self.max_entries = max_entries
+        self.keep_strongest = keep_strongest
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> [expires_at, rssi, held reading or None]
+        self.lock = threading.Lock()
+
+    def offer(self, key, rssi, reading, now):
+        """
+        Register a decoded advert. Returns the reading if it should be published
+        now, or None if it was a duplicate (or is being held for the window).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                STATS.inc("duplicates")
+                if self.keep_strongest and rssi > entry[1]:
+                    entry[1] = rssi
+                    entry[2] = reading
+                return None
+            if entry is not None:
+                del self.entries[key]  # stale; re-insert at the back
+            if len(self.entries) >= self.max_entries:
+                # Evicted held readings are lost rather than published late
+                self.entries.popitem(last=False)
+            if self.keep_strongest:
+                self.entries[key] = [now + self.window, rssi, reading]
+                return None
+            self.entries[key] = [now + self.window, rssi, None]
+            return reading
+
+    def expire(self, now):
+        """Drop finished windows; return held readings that are now due."""
+        due = []
+        with self.lock:
+            while self.entries:
+                key, entry = next(iter(self.entries.items()))
+                if entry[0] > now:
+                    break
+                del self.entries[key]
+                if entry[2] is not None:
+                    due.append(entry[2])
+        return due
+
+
+DEDUP = DedupWindow(DEDUP_WINDOW, DEDUP_MAX, DEDUP_MODE == "strongest") if DEDUP_WINDOW > 0 else None
+
+
+class DeadbandFilter:
+    """
+    Per-stream change filter: drops metric values that moved less than their
+    deadband since the last published value, unless the heartbeat has expired.
+
+    State per (source_node, mac) stream is one array('d') holding the last
+    published value and publish time for each metric slot (NaN = never).
+    Heartbeats run on `clock` (replay substitutes capture time).
+    """
+
+    METRICS = ("temperature", "humidity", "battery", "rssi")
+
+    def __init__(self, thresholds, heartbeat, clock=time.monotonic):
+        self.slots = {metric: i for i, metric in enumerate(self.METRICS)}
+        self.thresholds = thresholds
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.state = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_spec(cls, spec, heartbeat):
+        """Build from a DECODER_DEADBAND string like 'temperature=0.2,humidity=0.5'."""
+        thresholds = {}
+        for item in spec.split(","):
+            if not item.strip():
+                continue
+            metric, _, value = item.partition("=")
+            metric = metric.strip()
+            if metric not in cls.METRICS:
+                raise ValueError(f"unknown deadband metric '{metric}'")
+            thresholds[metric] = float(value)
+        return cls(thresholds, heartbeat)
+
+    def filter(self, key, fields, now):
+        """Return the subset of fields that should be published (may be empty)."""
+        size = len(self.METRICS)
+        passed = {}
+        with self.lock:
+            state = self.state.get(key)
+            if state is None:
+                state = self.state[key] = array("d", [math.nan]) * (2 * size)
+            for metric, value in fields.items():
+                slot = self.slots.get(metric)
+                threshold = self.thresholds.get(metric)
+                if slot is None or threshold is None:
+                    passed[metric] = value
+                    continue
+                last = state[slot]
+                if (last != last  # NaN: first value for this metric
+                        or abs(value - last) >= threshold
+                        or now - state[size + slot] >= self.heartbeat):
+                    state[slot] = value
+                    state[size + slot] = now
+                    passed[metric] = value
+        STATS.inc("metrics_in", len(fields))
+        STATS.inc("metrics_suppressed", len(fields) - len(passed))
+        return passed
+
+
+DEADBAND_FILTER = DeadbandFilter.from_spec(DEADBAND, HEARTBEAT) if DEADBAND else None
+
+
+class WindowAggregator:
+    """
+    Tumbling-window summaries per device (mac).
+
+    Readings of one sensor heard by several gateways fold into a single
+    summary, published under the gateway that heard it strongest in the
+    window. Each device holds one array('d') with sum/min/max/count for every
+    summarized metric plus the last battery value, so memory is O(active
+    devices) no matter how fast adverts arrive. flush() swaps the table out
+    when the window closes and turns each accumulator into a summary reading.
+    Windows are aligned to `clock` (replay substitutes capture time).
+    """
+
+    SUMMARIZED = ("temperature", "humidity", "rssi")
+
+    def __init__(self, window, clock=time.time):
+        self.window = window
+        self.streams = {}  # mac -> [device, array('d'), last battery, source_node, best rssi]
+        self.lock = threading.Lock()
+        self.set_clock(clock)
+
+    def set_clock(self, clock):
+        """Run windows on `clock` (wall seconds; replay substitutes capture time) and realign."""
+        with self.lock:
+            self.clock = clock
+            self.window_end = (clock() // self.window + 1) * self.window
+
+    def new_accumulator(self):
+        return array("d", [0.0, math.inf, -math.inf, 0.0]) * len(self.SUMMARIZED)
+
+    def add(self, reading):
+        """Fold one reading into its device's accumulator."""
+        source_node, device, mac, fields, ts = reading
+        rssi = fields.get("rssi")
+        with self.lock:
+            entry = self.streams.get(mac)
+            if entry is None:
+                entry = self.streams[mac] = [device, self.new_accumulator(), None, source_node, rssi]
+            else:
+                entry[0] = device  # keep the latest name/room
+                if rssi is not None and (entry[4] is None or rssi > entry[4]):
+                    entry[3], entry[4] = source_node, rssi
+            acc = entry[1]
+            for i, metric in enumerate(self.SUMMARIZED):
+                value = fields.get(metric)
+                if value is None:
+                    continue
+                base = 4 * i
+                acc[base] += value
+                if value < acc[base + 1]:
+                    acc[base + 1] = value
+                if value > acc[base + 2]:
+                    acc[base + 2] = value
+                acc[base + 3] += 1
+            if "battery" in fields:
+                entry[2] = fields["battery"]
+
+    def flush(self, now_wall):
+        """If the current window has closed, return its summary readings."""
+        if now_wall < self.window_end:
+            return []
+        with self.lock:
+            streams, self.streams = self.streams, {}
+            ts = int(self.window_end * 1000)
+            self.window_end = (now_wall // self.window + 1) * self.window
+        summaries = []
+        for mac, (device, acc, battery, source_node, _) in streams.items():
+            fields = {}
+            for i, metric in enumerate(self.SUMMARIZED):
+                count = acc[4 * i + 3]
+                if not count:
+                    continue
+                fields[metric] = acc[4 * i] / count
+                fields[f"{metric}_min"] = acc[4 * i + 1]
+                fields[f"{metric}_max"] = acc[4 * i + 2]
+            if battery is not None:
+                fields["battery"] = battery
+            fields["count"] = int(max(acc[4 * i + 3] for i in range(len(self.SUMMARIZED))))
+            summaries.append((source_node, device, mac, fields, ts))
+        return summaries
+
+
+AGGREGATOR = WindowAggregator(AGGREGATE_WINDOW) if AGGREGATE_WINDOW > 0 else None
+
+
+def dedup_key(mac, data, decoded):
+    """Identity of an advert: raw manufacturer data if present, else the decoded values."""
+    mfr = data.get("manufacturerdata")
+    if mfr:
+        return (mac, mfr)
+    return (mac, decoded["temp_f"], decoded["humidity"], decoded.get("battery"))
+
+
+class Spool:
+    """
+    Append-only on-disk queue of output records the sink couldn't accept.
+
+    Records are single text lines appended to numbered segment files; a new
+    segment starts every SEGMENT_BYTES, and once the total passes max_bytes
+    the oldest segment is deleted and its unread records counted as evicted.
+    The read position is kept in a small cursor file so a restarted decoder
+    resumes replay where it stopped. Safe to call from any thread.
+    """
+
+    SEGMENT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.cursor_path = os.path.join(directory, "cursor")
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(n[:-4]) for n in os.listdir(directory) if n.endswith(".seg"))
+        self.read_segment, self.read_offset = self.load_cursor()
+        self.counts = {}   # segment -> unread records
+        self.sizes = {}    # segment -> bytes on disk
+        for seg in list(self.segments):
+            if seg < self.read_segment:
+                os.remove(self.segment_path(seg))  # fully replayed before a restart
+                self.segments.remove(seg)
+                continue
+            with open(self.segment_path(seg), "rb") as f:
+                if seg == self.read_segment:
+                    f.seek(self.read_offset)
+                self.counts[seg] = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+            self.sizes[seg] = os.path.getsize(self.segment_path(seg))
+        if self.segments and self.read_segment not in self.counts:
+            self.read_segment, self.read_offset = self.segments[0], 0
+        self.out = None
+
+    def segment_path(self, seg):
+        return os.path.join(self.directory, f"{seg:012d}.seg")
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_path) as f:
+                cursor = json.load(f)
+            return int(cursor["segment"]), int(cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def save_cursor(self):
+        temp_path = f"{self.cursor_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"segment": self.read_segment, "offset": self.read_offset}, f)
+        os.replace(temp_path, self.cursor_path)
+
+    def depth(self):
+        return sum(self.counts.values())
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def append(self, records):
+        """Add records (str without newlines) to the newest segment."""
+        data = ("\n".join(records) + "\n").encode()
+        evicted = 0
+        with self.lock:
+            if self.out is None or self.sizes[self.segments[-1]] >= self.SEGMENT_BYTES:
+                if self.out is not None:
+                    self.out.close()
+                if self.segments:
+                    seg = self.segments[-1] + 1
+                else:
+                    seg = self.read_segment = max(self.read_segment, 1)
+                    self.read_offset = 0
+                self.segments.append(seg)
+                self.counts[seg] = 0
+                self.sizes[seg] = 0
+                self.out = open(self.segment_path(seg), "ab")
+            seg = self.segments[-1]
+            self.out.write(data)
+            self.out.flush()
+            self.counts[seg] += len(records)
+            self.sizes[seg] += len(data)
+            while self.size() > self.max_bytes and len(self.segments) > 1:
+                oldest = self.segments.pop(0)
+                evicted += self.counts.pop(oldest)
+                del self.sizes[oldest]
+                os.remove(self.segment_path(oldest))
+                if oldest == self.read_segment:
+                    self.read_segment, self.read_offset = self.segments[0], 0
+        STATS.inc("spooled", len(records))
+        if evicted:
+            STATS.inc("spool_evicted", evicted)
+
+    def pop(self, limit):
+        """Remove and return up to `limit` of the oldest records."""
+        records = []
+        with self.lock:
+            while self.segments and len(records) < limit:
+                seg = self.segments[0]
+                with open(self.segment_path(seg), "rb") as f:
+                    f.seek(self.read_offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # torn write from a crash; skip the fragment
+                        records.append(line[:-1].decode())
+                        self.read_offset += len(line)
+                        self.counts[seg] -= 1
+                        if len(records) >= limit:
+                            break
+                if self.read_offset < self.sizes[seg] and len(records) >= limit:
+                    break
+                # Segment exhausted: delete it (closing it first if it's the one being written)
+                if len(self.segments) == 1 and self.out is not None:
+                    self.out.close()
+                    self.out = None
+                self.segments.pop(0)
+                del self.counts[seg], self.sizes[seg]
+                os.remove(self.segment_path(seg))
+                self.read_segment, self.read_offset = (self.segments[0] if self.segments else seg + 1), 0
+            self.save_cursor()
+        return records
+
+
+# Disk spool (set in main unless DECODER_SPOOL_MAX_MB=0)
+SPOOL = None
+
+
+def escape_tag(value):
+    """Escape a tag key/value for InfluxDB line protocol."""
+    return (str(value).replace("\\", "\\\\").replace(",", "\\,")
+            .replace("=", "\\=").replace(" ", "\\ "))
+
+
+class InfluxWriter:
+    """
+    Batched line-protocol writer for InfluxDB's /api/v2/write endpoint.
+
+    Readings become the same points Telegraf writes for the scalar pipeline
+    (measurement mqtt_consumer, one 'value' field per sensor_type, same tags),
+    so dashboards can't tell the difference. Lines wait in a bounded deque
+    (oldest dropped when full); a background thread posts gzip'd batches once
+    BATCH lines are queued or FLUSH seconds pass, retrying failures with
+    exponential backoff. close() posts what is left on shutdown and spools
+    whatever InfluxDB doesn't take.
+    """
+
+    MEASUREMENT = "mqtt_consumer"
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, url, token, org, bucket, batch, flush, buffer):
+        query = urllib.parse.urlencode({"org": org, "bucket": bucket, "precision": "ms"})
+        self.write_url = f"{url.rstrip('/')}/api/v2/write?{query}"
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip",
+        }
+        self.batch = batch
+        self.flush = flush
+        self.buffer = buffer
+        self.lines = deque()
+        self.cond = threading.Condition()
+        self.healthy = True
+        self.closing = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="influx-writer", daemon=True)
+        self.thread.start()
+
+    def close(self, timeout=8.0):
+        """Final flush on shutdown: post the buffer, spool (or count as dropped) the rest."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        with self.cond:
+            left = list(self.lines)
+            self.lines.clear()
+        if left:  # Writer still stuck in a request: keep what it hasn't taken
+            self.park(left)
+
+    def park(self, lines):
+        """Hand lines InfluxDB didn't accept to the spool, or count them as dropped."""
+        if SPOOL is not None:
+            SPOOL.append(lines)
         else:
-            # Normal mode: MAC is in the topic
-            mac = topic_last.replace(":", "").upper()
+            STATS.inc("influx_dropped", len(lines))
 
-        if os.getenv("DEBUG_DECODER"): print(f"DEBUG: Received from {msg.topic}, MAC: {mac}")
+    def reading_lines(self, source_node, device, mac, fields, ts):
+        """Line-protocol lines for one reading (tags sorted, as InfluxDB prefers)."""
+        heads = OUTPUT_CACHE.get(source_node, device, mac)[2]
+        return [f"{heads[metric]}{float(value)!r} {ts}" for metric, value in fields.items()]
 
-        # Match device by MAC suffix
-        device = None
-        for suffix, info in DEVICES.items():
-            if suffix.endswith(mac) or mac.endswith(suffix[-len(mac):]):
-                device = info
-                break
+    def write_reading(self, source_node, device, mac, fields, ts):
+        """Queue one reading; never blocks on the network."""
+        self.write_lines(self.reading_lines(source_node, device, mac, fields, ts))
+
+    def write_lines(self, lines):
+        """Queue line-protocol lines; overflow goes to the spool (or is dropped)."""
+        overflow = []
+        with self.cond:
+            for line in lines:
+                if len(self.lines) >= self.buffer:
+                    overflow.append(self.lines.popleft())
+                self.lines.append(line)
+            if len(self.lines) >= self.batch:
+                self.cond.notify()
+        if overflow:
+            if SPOOL is not None:
+                SPOOL.append(overflow)
+            else:
+                STATS.inc("influx_dropped", len(overflow))
+
+    def depth(self):
+        return len(self.lines)
+
+    def post(self, lines):
+        """POST one batch. Returns None on success, else (retryable, reason)."""
+        body = gzip.compress("\n".join(lines).encode(), compresslevel=5)
+        request = urllib.request.Request(self.write_url, data=body, headers=self.headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as resp:
+                resp.read()
+            return None
+        except urllib.error.HTTPError as e:
+            # 429/5xx are transient; other 4xx mean the batch itself is bad
+            return (e.code == 429 or e.code >= 500), f"HTTP {e.code}: {e.read()[:200]!r}"
+        except Exception as e:
+            return True, str(e)
+
+    def run(self):
+        backoff = 0.0
+        while True:
+            with self.cond:
+                if len(self.lines) < self.batch and not self.closing:
+                    self.cond.wait(self.flush)
+                batch = [self.lines.popleft() for _ in range(min(self.batch, len(self.lines)))]
+                if not batch and self.closing:
+                    return
+            while batch:
+                failure = self.post(batch)
+                if failure is None:
+                    STATS.inc("influx_lines", len(batch))
+                    STATS.inc("influx_batches")
+                    self.healthy = True
+                    backoff = 0.0
+                    break
+                retryable, reason = failure
+                if not retryable:
+                    LOG.warning("influx", f"InfluxDB rejected {len(batch)} lines: {reason}",
+                                lines=len(batch), error=reason)
+                    STATS.inc("influx_dropped", len(batch))
+                    break
+                self.healthy = False
+                if self.closing:
+                    # Shutting down: no more retries, keep everything for the next start
+                    with self.cond:
+                        batch.extend(self.lines)
+                        self.lines.clear()
+                    self.park(batch)
+                    LOG.warning("influx", f"InfluxDB write failed ({reason}) on shutdown, "
+                                f"{'spooled' if SPOOL is not None else 'dropped'} {len(batch)} lines",
+                                error=reason, lines=len(batch), spooled=SPOOL is not None)
+                    return
+                STATS.inc("influx_retries")
+                backoff = min(max(backoff * 2, 1.0), self.MAX_BACKOFF)
+                if SPOOL is not None:
+                    # Park this batch and everything queued behind it on disk;
+                    # the next batch to arrive probes whether InfluxDB is back
+                    with self.cond:
+                        batch.extend(self.lines)
+                        self.lines.clear()
+                    SPOOL.append(batch)
+                    batch = []
+                    LOG.warning("influx", f"InfluxDB write failed ({reason}), spooling, next attempt in {backoff:.0f}s",
+                                error=reason, spooled=True, backoff_seconds=backoff)
+                else:
+                    LOG.warning("influx", f"InfluxDB write failed ({reason}), retrying in {backoff:.0f}s",
+                                error=reason, spooled=False, backoff_seconds=backoff)
+                with self.cond:  # close() cuts the backoff short
+                    if not self.closing:
+                        self.cond.wait(backoff)
+
+
+# Direct InfluxDB sink (set in main when DECODER_SINK=influx)
+INFLUX = None
+
+
+def publish_reading(client, source_node, device, mac, fields, ts=None):
+    """Publish one reading to the configured sink in the configured OUTPUT_MODE."""
+    if ts is None:
+        ts = int(time.time() * 1000)
+    if INFLUX is not None:
+        INFLUX.write_reading(source_node, device, mac, fields, ts)
+        return
+
+    if OUTPUT_MODE == "json":
+        payload = {
+            "ts": ts,
+            "source_node": source_node,
+            "room": device["room"],
+            "device_name": device["name"],
+            "z_device_id": mac,
+        }
+        payload.update(fields)
+        topic = OUTPUT_CACHE.get(source_node, device, mac)[1]
+        payload = json_dumps(payload)
+        if SPOOL is None:
+            if client.publish(topic, payload, retain=False).rc != mqtt.MQTT_ERR_SUCCESS:
+                STATS.inc("publish_errors")
+        elif (not client.is_connected()
+              or client.publish(topic, payload, retain=False).rc != mqtt.MQTT_ERR_SUCCESS):
+            # Broker unavailable: keep it on disk until replay_spool() can send it
+            SPOOL.append([f"{topic}\t{payload.decode() if isinstance(payload, bytes) else payload}"])
+        return
+
+    # Output topics: {site}/{node}/{source_node}/{room}/{device}/{mac}/{metric}
+    topics = OUTPUT_CACHE.get(source_node, device, mac)[0]
+    
+    # Publish each metric
+    for metric, value in fields.items():
+        if client.publish(topics[metric], value, retain=False).rc != mqtt.MQTT_ERR_SUCCESS:
+            STATS.inc("publish_errors")
+
+
+def telegraf_json_config():
+    """
+    Telegraf input for OUTPUT_MODE=json.
+
+    json_v2 reads the tags straight from the document (no topic regex), then
+    unpivot turns the multi-field metric back into one metric per sensor_type
+    with a single "value" field - the same schema the scalar pipeline writes,
+    so existing dashboards keep working.
+    """
+    tags = "".join(
+        f"""    [[inputs.mqtt_consumer.json_v2.tag]]\n      path = "{tag}"\n"""
+        for tag in ("source_node", "room", "device_name", "z_device_id")
+    )
+    # Aggregate-window summaries add _min/_max and count; all fields are optional
+    names = ["temperature", "humidity", "battery", "rssi"]
+    names += [f"{metric}_{stat}" for metric in WindowAggregator.SUMMARIZED for stat in ("min", "max")]
+    names.append("count")
+    fields = "".join(
+        f"""    [[inputs.mqtt_consumer.json_v2.field]]\n      path = "{field}"\n      type = "float"\n      optional = true\n"""
+        for field in names
+    )
+    return f"""# Generated by ble_decoder.py --telegraf-json-config (DECODER_OUTPUT=json)
+[[inputs.mqtt_consumer]]
+  servers = ["tcp://mosquitto:1883"]
+  topics = ["{SHOWSITE}/{JSON_NODE}/#"]
+  data_format = "json_v2"
+  topic_tag = ""
+  name_override = "decoder_reading"
+  [inputs.mqtt_consumer.tags]
+    source = "{DECODER_NODE}"
+  [[inputs.mqtt_consumer.json_v2]]
+    timestamp_path = "ts"
+    timestamp_format = "unix_ms"
+{tags}{fields}
+[[processors.unpivot]]
+  namepass = ["decoder_reading"]
+  order = 1
+  tag_key = "sensor_type"
+  value_key = "value"
+
+[[processors.rename]]
+  namepass = ["decoder_reading"]
+  order = 2
+  [[processors.rename.replace]]
+    measurement = "decoder_reading"
+    dest = "mqtt_consumer"
+"""
+
+
+class WorkerPool:
+    """
+    Bounded per-worker queues feeding decode threads.
+
+    Messages whose MAC is known from the topic always go to the same worker
+    (hash of the MAC), so each device's readings stay in order on one thread;
+    'undecoded' messages are spread round-robin. on_message is the only
+    producer, which keeps drop-oldest race-free.
+    """
+
+    def __init__(self, client, workers, max_size, overflow):
+        self.client = client
+        self.queues = [queue.Queue(max_size) for _ in range(workers)]
+        self.block = overflow == "block"
+        self.next = 0
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self.run, args=(q,), name=f"decoder-{i}", daemon=True).start()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def submit(self, item, mac):
+        """Queue (topic, payload, mac, device, enqueued_at) for a worker."""
+        if mac:
+            q = self.queues[hash(mac) % len(self.queues)]
+        else:
+            self.next = (self.next + 1) % len(self.queues)
+            q = self.queues[self.next]
+        if self.block:
+            q.put(item)
+            return
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            try:
+                q.get_nowait()
+                STATS.inc("queue_dropped")
+            except queue.Empty:
+                pass
+            q.put_nowait(item)
 
+    def run(self, q):
+        client = self.client
+        while True:
+            topic, payload, mac, device, enqueued = q.get()
+            started = time.monotonic()
+            session = PROFILE
+            if session is not None:
+                session.tick()
+            process_message(client, topic, payload, mac, device)
+            finished = time.monotonic()
+            QUEUE_WAIT.observe(started - enqueued)
+            PROCESS_TIME.observe(finished - started)
+            counts = STATS.shard()
+            counts["processed"] += 1
+            counts["latency_sum"] += finished - enqueued
+
+
+# Decode workers; None when decoding inline on paho's thread (set in main)
+POOL = None
+
+
+def shard_owns(mac):
+    """True if this instance handles mac (always, unless hash sharding)."""
+    if SHARD_MODE != "hash":
+        return True
+    # crc32 rather than hash(): it must agree across processes and hosts
+    return zlib.crc32(mac[-12:].encode()) % SHARD_COUNT == SHARD_INDEX
+
+
+def check_shard_config():
+    """Reject shard settings that would split a device's state across instances."""
+    if SHARD_MODE not in ("none", "hash", "shared"):
+        return f"unknown DECODER_SHARD_MODE '{SHARD_MODE}'"
+    if SHARD_MODE == "hash" and not 0 <= SHARD_INDEX < SHARD_COUNT:
+        return f"DECODER_SHARD_INDEX must be in 0..{SHARD_COUNT - 1}"
+    if REPLICA and SHARD_MODE != "shared":
+        # Identical copies in mode none (or one hash index) would each process
+        # every message and duplicate all output
+        return ("--replica needs DECODER_SHARD_MODE=shared, set for every instance "
+                "(ble-decoder too) so the broker splits messages between them")
+    if SHARD_MODE == "shared":
+        # The broker round-robins individual messages, so one device's adverts
+        # land on every instance and per-device state would be wrong
+        stateful = [name for name, stage in (
+            ("DECODER_DEDUP_WINDOW", DEDUP),
+            ("DECODER_DEADBAND", DEADBAND_FILTER),
+            ("DECODER_AGGREGATE_WINDOW", AGGREGATOR),
+        ) if stage is not None]
+        if stateful:
+            return (f"shared subscriptions split devices across instances; "
+                    f"use DECODER_SHARD_MODE=hash with {', '.join(stateful)}")
+    return None
+
+
+def shard_label():
+    """Short description of this instance's shard for log lines."""
+    if SHARD_MODE == "hash":
+        return f"shard {SHARD_INDEX}/{SHARD_COUNT}"
+    if SHARD_MODE == "shared":
+        return f"shared group {SHARE_GROUP}"
+    return ""
+
+
+def on_message(client, userdata, msg):
+    """Classify an incoming BLE message and hand it to a decode worker."""
+    STATS.inc("received")
+    session = PROFILE
+    if session is not None:
+        session.tick()
+        session.stages.start()
+    topic = msg.topic
+    # Extract MAC - either from topic or from payload (if extDecoderEnable=true)
+    # (cached per topic once a registered device has used it; other topics only
+    # have their MAC cut out - source_node is parsed for known devices only)
+    info = TOPICS.get(topic)
+    mac = info[0] if info is not None else topic_mac(topic)
+    if mac is None:
+        # extDecoderEnable mode: MAC is in the "id" field, resolved after parsing
+        device = None
+    else:
+        # Normal mode: MAC is in the topic, so unknown devices (phones,
+        # iBeacons, neighbours' sensors) are dropped before touching the payload
+        if not shard_owns(mac):
+            STATS.inc("dropped_shard")
+            return  # Another instance handles this device
+        device = DEVICE_INDEX.lookup(mac)
+        if DEBUG:
+            LOG.debug("received", f"Received from {topic}, MAC: {mac}", topic=topic, mac=mac)
         if not device:
+            STATS.inc("dropped_unknown")
             return  # Unknown device, skip
+        if session is not None:
+            session.stages.mark("lookup")
+
+    if POOL is None:
+        started = time.monotonic()
+        process_message(client, topic, msg.payload, mac, device)
+        PROCESS_TIME.observe(time.monotonic() - started)
+    else:
+        POOL.submit((topic, msg.payload, mac, device, time.monotonic()), mac)
+
+
+def process_message(client, topic, payload, mac, device):
+    """Parse, decode and publish one message from a registered (or undecoded-topic) device."""
+    # Per-stage timing only while a profile capture is running
+    session = PROFILE
+    stages = session.stages if session is not None else None
+    try:
+        if stages is not None:
+            stages.start()
+        data = json_loads(payload)
+        if stages is not None:
+            stages.mark("parse")
+        if device is None:
+            mac = data.get("id", "").replace(":", "").upper()
+            if not shard_owns(mac):
+                STATS.inc("dropped_shard")
+                return  # Another instance handles this device
+            device = DEVICE_INDEX.lookup(mac)
+            if DEBUG:
+                LOG.debug("received", f"Received from {topic}, MAC: {mac}", topic=topic, mac=mac)
+            if not device:
+                STATS.inc("dropped_unknown")
+                return  # Unknown device, skip
+            if stages is not None:
+                stages.mark("lookup")
         
         # Debug: show device info and available data
-        if os.getenv("DEBUG_DECODER"):
-            print(f"  Device: {device['name']} ({device['sku']}), Room: {device['room']}")
-            if "manufacturerdata" in data:
-                print(f"  Raw hex: {data['manufacturerdata']}")
-            if "tempf" in data:
-                print(f"  Pre-decoded: {data['tempf']}°F, {data['hum']}%, batt: {data.get('batt')}%")
+        if DEBUG:
+            LOG.debug("payload", f"Device: {device['name']} ({device['sku']}), Room: {device['room']}"
+                      + (f", raw hex: {data['manufacturerdata']}" if "manufacturerdata" in data else "")
+                      + (f", pre-decoded: {data['tempf']}°F, {data['hum']}%, batt: {data.get('batt')}%"
+                         if "tempf" in data else ""),
+                      mac=mac, data=data)
         
         # Prefer pre-decoded values (ESP32/Theengs firmware already decoded)
         if "tempf" in data and "hum" in data:
@@ -252,101 +1934,711 @@ def on_message(client, userdata, msg):
             # Fallback: manual decode of raw manufacturerdata
             mfr = data.get("manufacturerdata")
             if not mfr:
+                STATS.inc("dropped_no_data")
                 return  # No data available
             
             # Get decoder for this device model
             decoder = DECODERS.get(device["sku"])
             if not decoder:
+                STATS.inc("dropped_no_data")
+                DECODE_FAILURES.inc(device["sku"])
                 return  # No decoder for this model
             
-            # Decode the manufacturer data
-            b = bytes.fromhex(mfr)
-            decoded = decoder(b)
+            # Decode the manufacturer data (usually a cache hit: unchanged adverts repeat)
+            cache = DECODE_CACHES.get(device["sku"])
+            decoded = cache.decode(mfr) if cache is not None else decoder(bytes.fromhex(mfr))
             
             if not decoded:
+                STATS.inc("dropped_no_data")
+                DECODE_FAILURES.inc(device["sku"])
                 return  # Decoding failed
+        if stages is not None:
+            stages.mark("decode")
         
-        # Extract source node from incoming topic
-        source_node = extract_source_node(msg.topic)
-        
-        # Build output topic path
-        # Format: {site}/{node}/{source_node}/{room}/{device}/{mac}/{metric}
-        room = device["room"]
-        device_name = device["name"]
-        base_topic = f"{SHOWSITE}/{DECODER_NODE}/{source_node}/{room}/{device_name}/{mac}"
-        
-        # Publish each metric
-        client.publish(f"{base_topic}/temperature", decoded["temp_f"], retain=False)
-        client.publish(f"{base_topic}/humidity", decoded["humidity"], retain=False)
+        # Source node parsed once per topic (only registered devices get here)
+        source_node = TOPICS[topic][1]
+
+        # Collect metrics for this reading; keys are the published sensor_type names
+        fields = {
+            "temperature": decoded["temp_f"],
+            "humidity": decoded["humidity"],
+        }
         if "battery" in decoded:
-            client.publish(f"{base_topic}/battery", decoded["battery"], retain=False)
+            fields["battery"] = decoded["battery"]
         
         # Optional: Publish RSSI if available
         rssi = data.get("rssi")
         if rssi:
-            client.publish(f"{base_topic}/rssi", rssi, retain=False)
-        
-        print(
-            f"{datetime.now().strftime('%H:%M:%S')} [{source_node}] {room}/{device_name}: "
-            f"{decoded['temp_f']:.2f}°F, {decoded['humidity']:.1f}%, "
-            f"batt: {decoded.get('battery', '?')}%"
-            )
+            fields["rssi"] = rssi
+
+        STATS.inc("decoded")
+        GATEWAY_STATS.inc(source_node)
+        reading = (source_node, device, mac, fields, int(time.time() * 1000))
+
+        # Collapse copies of the same advert relayed by other gateways
+        if DEDUP is not None:
+            reading = DEDUP.offer(dedup_key(mac, data, decoded), rssi or -999, reading, DEDUP.clock())
+            if reading is None:
+                return
+
+        emit_reading(client, reading)
         
     except json.JSONDecodeError as e:
-        print(f"JSON decode error on {msg.topic}: {e}")
+        STATS.inc("errors")
+        if LOG.allow(("error", topic), 60, time.monotonic()):
+            LOG.warning("json_error", f"JSON decode error on {topic}: {e}", topic=topic, error=str(e))
     except Exception as e:
-        print(f"Error processing {msg.topic}: {e}")
+        STATS.inc("errors")
+        if LOG.allow(("error", topic), 60, time.monotonic()):
+            LOG.warning("error", f"Error processing {topic}: {e}", topic=topic, error=str(e))
+
+
+def emit_reading(client, reading):
+    """Route a decoded, deduplicated reading to the aggregator or straight out."""
+    if AGGREGATOR is not None:
+        AGGREGATOR.add(reading)
+        return
+    output_reading(client, reading)
+
+
+def output_reading(client, reading):
+    """Apply the deadband filter, then publish a reading and print its log line."""
+    source_node, device, mac, fields, ts = reading
+    if DEADBAND_FILTER is not None:
+        fields = DEADBAND_FILTER.filter((source_node, mac), fields, DEADBAND_FILTER.clock())
+        if not fields:
+            return  # Nothing changed enough and no heartbeat due
+    publish_reading(client, source_node, device, mac, fields, ts)
+    STATS.inc("published")
+    session = PROFILE
+    if session is not None:
+        session.stages.mark("publish")
+    if LOG_READINGS == "all" or (LOG_READINGS == "sample" and LOG.allow(mac, LOG_SAMPLE, time.monotonic())):
+        LOG.info("reading", render_reading, source_node=source_node, room=device["room"],
+                 device=device["name"], mac=mac, **fields)
+    if session is not None:
+        session.stages.mark("log")
+
+
+def log_stats(elapsed):
+    """Log summary lines of the message counters since the last call."""
+    global _stats_previous, _gateway_previous
+    snapshot = STATS.snapshot()
+    delta = {k: v - _stats_previous.get(k, 0) for k, v in snapshot.items()}
+    _stats_previous = snapshot
+    rate = delta["received"] / elapsed if elapsed > 0 else 0.0
+    age = devices_age()
+    map_age = f"map age {age:.0f}s" if age is not None else "map never fetched"
+    shard = f" [{shard_label()}, other shards {delta['dropped_shard']}]" if SHARD_MODE == "hash" else ""
+    LOG.info(
+        "stats",
+        f"STATS{shard} {rate:.1f} msg/s | "
+        f"received {delta['received']}, decoded {delta['decoded']}, "
+        f"published {delta['published']}, duplicates {delta['duplicates']}, "
+        f"dropped unknown {delta['dropped_unknown']}, no data {delta['dropped_no_data']}, "
+        f"errors {delta['errors']} (devices: {len(DEVICE_INDEX)}, {map_age})",
+        counters=delta,
+    )
+    gateways = GATEWAY_STATS.snapshot()
+    if gateways:
+        # Decoded readings, not raw messages: gateways are only counted once a
+        # message decodes (unknown/undecodable traffic is in the totals above)
+        rates = {node: round((count - _gateway_previous.get(node, 0)) / elapsed, 1)
+                 for node, count in sorted(gateways.items())}
+        text = ", ".join(f"{node} {rate:.1f}/s" for node, rate in rates.items())
+        LOG.info("stats", f"STATS decoded readings per gateway: {text}", readings_per_second=rates)
+    _gateway_previous = gateways
+    if delta["log_dropped"]:
+        LOG.warning("stats", f"STATS log writer fell behind, dropped {delta['log_dropped']} lines")
+    if POOL is not None:
+        latency = delta["latency_sum"] / delta["processed"] * 1000 if delta["processed"] else 0.0
+        LOG.info(
+            "stats",
+            f"STATS queue depth {POOL.depth()}, "
+            f"overflow dropped {delta['queue_dropped']}, avg latency {latency:.2f}ms"
+        )
+    if INFLUX is not None:
+        LOG.info(
+            "stats",
+            f"STATS influx wrote {delta['influx_lines']} lines "
+            f"in {delta['influx_batches']} batches, retries {delta['influx_retries']}, "
+            f"dropped {delta['influx_dropped']}, buffered {INFLUX.depth()}"
+        )
+    if SPOOL is not None and (SPOOL.depth() or delta["spooled"] or delta["spool_replayed"]):
+        LOG.info(
+            "stats",
+            f"STATS spool depth {SPOOL.depth()} records "
+            f"({SPOOL.size() / 1e6:.1f} MB), spooled {delta['spooled']}, "
+            f"replayed {delta['spool_replayed']} ({delta['spool_replayed'] / elapsed:.0f}/s), "
+            f"evicted {delta['spool_evicted']}"
+        )
+    lookups = delta["decode_cache_hits"] + delta["decode_cache_misses"]
+    if lookups:
+        LOG.info(
+            "stats",
+            f"STATS decode cache hit rate "
+            f"{delta['decode_cache_hits'] / lookups:.0%} ({delta['decode_cache_hits']}/{lookups}), "
+            f"{sum(len(cache) for cache in DECODE_CACHES.values())} entries"
+        )
+    if DEADBAND_FILTER is not None and delta["metrics_in"]:
+        ratio = delta["metrics_suppressed"] / delta["metrics_in"]
+        LOG.info(
+            "stats",
+            f"STATS deadband suppressed "
+            f"{delta['metrics_suppressed']}/{delta['metrics_in']} metric values ({ratio:.0%}), "
+            f"tracking {len(DEADBAND_FILTER.state)} streams"
+        )
+
+
+
+# Process start, and (time, counters, per-gateway) samples taken by housekeeping
+# every METRICS_SAMPLE seconds so /metrics.json can report recent rates
+STARTED_AT = time.monotonic()
+METRICS_SAMPLE = 10
+METRICS_HISTORY = deque(maxlen=7)
+_next_metrics_sample = 0.0
+
+
+def collect_metrics():
+    """Counters, per-gateway/per-SKU counts, histograms and gauges as one dict."""
+    now = time.monotonic()
+    counters = STATS.snapshot()
+    counters.pop("latency_sum")  # covered by the histograms
+    gateways = GATEWAY_STATS.snapshot()
+    age = devices_age()
+    gauges = {
+        "uptime_seconds": now - STARTED_AT,
+        "devices": len(DEVICE_INDEX),
+        "device_map_age_seconds": age if age is not None else -1,
+        "queue_depth": POOL.depth() if POOL is not None else 0,
+        "decode_cache_entries": sum(len(cache) for cache in DECODE_CACHES.values()),
+    }
+    if INFLUX is not None:
+        gauges["influx_buffered_lines"] = INFLUX.depth()
+    if SPOOL is not None:
+        gauges["spool_records"] = SPOOL.depth()
+        gauges["spool_bytes"] = SPOOL.size()
+
+    since, old_counters, old_gateways = METRICS_HISTORY[0] if METRICS_HISTORY else (STARTED_AT, {}, {})
+    window = max(now - since, 1e-9)
+    return {
+        "counters": counters,
+        "gateway_readings": gateways,
+        "decode_failures": DECODE_FAILURES.snapshot(),
+        "histograms": {
+            "process_seconds": PROCESS_TIME.snapshot(),
+            "queue_wait_seconds": QUEUE_WAIT.snapshot(),
+        },
+        "gauges": gauges,
+        "rates": {
+            "window_seconds": window,
+            "received_per_second": (counters["received"] - old_counters.get("received", 0)) / window,
+            "published_per_second": (counters["published"] - old_counters.get("published", 0)) / window,
+            "gateway_readings_per_second": {
+                node: (count - old_gateways.get(node, 0)) / window for node, count in gateways.items()
+            },
+        },
+    }
+
+
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(metrics):
+    """Prometheus text exposition (format 0.0.4) of collect_metrics()."""
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP ble_decoder_{name} {help_text}")
+        lines.append(f"# TYPE ble_decoder_{name} {kind}")
+
+    for name, value in metrics["counters"].items():
+        family(f"{name}_total", "counter", f"Decoder counter: {name.replace('_', ' ')}")
+        lines.append(f"ble_decoder_{name}_total {value}")
+    family("gateway_readings_total", "counter", "Decoded readings per source gateway")
+    for node, value in sorted(metrics["gateway_readings"].items()):
+        lines.append(f'ble_decoder_gateway_readings_total{{source_node="{prometheus_label(node)}"}} {value}')
+    family("decode_failures_total", "counter", "Raw decodes that failed per device model")
+    for sku, value in sorted(metrics["decode_failures"].items()):
+        lines.append(f'ble_decoder_decode_failures_total{{sku="{prometheus_label(sku)}"}} {value}')
+    for name, (cumulative, count, total) in metrics["histograms"].items():
+        family(name, "histogram", f"Per-message {name.replace('_', ' ')}")
+        for bound, value in zip(LATENCY_BOUNDS, cumulative):
+            lines.append(f'ble_decoder_{name}_bucket{{le="{bound}"}} {value}')
+        lines.append(f'ble_decoder_{name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"ble_decoder_{name}_sum {total}")
+        lines.append(f"ble_decoder_{name}_count {count}")
+    for name, value in metrics["gauges"].items():
+        family(name, "gauge", f"Decoder {name.replace('_', ' ')}")
+        lines.append(f"ble_decoder_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics (Prometheus) and /metrics.json, POST /profile?seconds=N;
+    everything else is 404.
+    """
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = render_prometheus(collect_metrics()).encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            metrics = collect_metrics()
+            metrics["histograms"] = {
+                name: {"bounds": LATENCY_BOUNDS, "cumulative": cumulative, "count": count, "sum": total}
+                for name, (cumulative, count, total) in metrics["histograms"].items()
+            }
+            body = json.dumps(metrics, separators=(",", ":")).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_body(200, body, content_type)
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/profile":
+            self.send_error(404)
+            return
+        if not PROFILE_HTTP:
+            self.send_error(403, "POST /profile is disabled (set DECODER_PROFILE_HTTP=1)")
+            return
+        try:
+            seconds = float(urllib.parse.parse_qs(url.query).get("seconds", [PROFILE_SECONDS])[0])
+            if not math.isfinite(seconds):
+                raise ValueError(seconds)
+        except ValueError:
+            self.send_error(400, "seconds must be a number")
+            return
+        session = request_profile(min(max(seconds, 1), PROFILE_MAX_SECONDS), "HTTP")
+        if session is None:
+            self.send_error(409, "A profile capture is already running")
+            return
+        body = json.dumps({"seconds": session.seconds, "report": session.path + ".txt",
+                           "pstats": session.path + ".pstats"}).encode()
+        self.send_body(202, body, "application/json")
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # Scrapes would flood the decoder log
+
+
+def start_metrics_server(port, bind=METRICS_BIND):
+    """Serve MetricsHandler on `bind`:`port` on a daemon thread."""
+    server = ThreadingHTTPServer((bind, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+PIPELINE_STAGES = ("lookup", "parse", "decode", "publish", "log")
+
+
+class StageTimer(Counters):
+    """
+    Wall time per pipeline stage, summed per thread like the message counters.
+
+    start() opens a message on the calling thread; each mark(stage) charges
+    the time since the previous mark to that stage. Marks on a thread with
+    no open message (housekeeping flushes) are ignored.
+    """
+
+    def __init__(self):
+        super().__init__([name for stage in PIPELINE_STAGES for name in (stage, stage + "_calls")])
+
+    def start(self):
+        self.local.last = time.perf_counter()
+
+    def mark(self, stage):
+        last = getattr(self.local, "last", None)
+        if last is None:
+            return
+        now = time.perf_counter()
+        counts = self.shard()
+        counts[stage] += now - last
+        counts[stage + "_calls"] += 1
+        self.local.last = now
+
+
+class ProfileSession:
+    """
+    One timed capture: cProfile of the message threads, a tracemalloc diff
+    and the per-stage wall time, written to PROFILE_DIR by finish().
+
+    cProfile only sees the thread that enabled it, so paho's thread and the
+    decode workers attach themselves on their next message (tick()) and
+    detach on their first message after the deadline. The report is written
+    once all of them have detached or PROFILE_GRACE seconds later, leaving
+    out threads that were still idle.
+    """
+
+    def __init__(self, seconds, reason):
+        self.seconds = seconds
+        self.reason = reason
+        self.started_at = datetime.now()
+        self.started = time.monotonic()
+        self.deadline = self.started + seconds
+        self.path = os.path.join(PROFILE_DIR, f"profile-{self.started_at:%Y%m%d-%H%M%S}")
+        self.profiles = {}  # thread ident -> (thread name, cProfile.Profile or None)
+        self.detached = set()
+        self.lock = threading.Lock()
+        self.written = False
+        self.stages = StageTimer()
+        self.counters = STATS.snapshot()
+        self.own_tracing = not tracemalloc.is_tracing()
+        if self.own_tracing:
+            tracemalloc.start()
+        self.snapshot = tracemalloc.take_snapshot()
+
+    def tick(self):
+        """Attach the calling thread before the deadline, detach it after (once per message)."""
+        ident = threading.get_ident()
+        if time.monotonic() < self.deadline:
+            if ident not in self.profiles:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    profile = None  # Python 3.12+: the first thread's profiler sees every thread
+                with self.lock:
+                    self.profiles[ident] = (threading.current_thread().name, profile)
+        elif ident in self.profiles and ident not in self.detached:
+            profile = self.profiles[ident][1]
+            if profile is not None:
+                profile.disable()
+            with self.lock:
+                self.detached.add(ident)
+
+    def idle(self):
+        """True once no thread has this session's profiler enabled."""
+        with self.lock:
+            return all(ident in self.detached or profile is None
+                       for ident, (name, profile) in self.profiles.items())
+
+    def finish(self):
+        """Stop tracing and write <path>.txt (report) and <path>.pstats (merged cProfile data)."""
+        elapsed = time.monotonic() - self.started
+        snapshot = tracemalloc.take_snapshot()
+        if self.own_tracing:
+            tracemalloc.stop()
+        self.written = True
+        with self.lock:
+            threads = [(name, profile, ident in self.detached)
+                       for ident, (name, profile) in self.profiles.items()]
+        profiles = [profile for name, profile, detached in threads if detached and profile is not None]
+        counters = STATS.snapshot()
+        received = counters["received"] - self.counters["received"]
+        decoded = counters["decoded"] - self.counters["decoded"]
+
+        out = io.StringIO()
+        out.write(f"ble-decoder profile {self.started_at:%Y-%m-%d %H:%M:%S} "
+                  f"({self.reason}, {elapsed:.1f}s)\n")
+        out.write(f"Messages: {received} received, {decoded} decoded ({received / elapsed:.0f}/s)\n")
+        out.write(f"Threads profiled: {', '.join(name for name, profile, detached in threads if detached) or 'none'}\n")
+        idle = [name for name, profile, detached in threads if not detached]
+        if idle:
+            out.write(f"Idle after the deadline (not in cProfile data): {', '.join(idle)}\n")
+        out.write("Timings include cProfile and tracemalloc overhead: compare stages with each other, "
+                  "not with /metrics\n")
+
+        stages = self.stages.snapshot()
+        total = sum(stages[stage] for stage in PIPELINE_STAGES) or 1
+        out.write(f"\nPer-stage wall time\n  {'stage':<8} {'calls':>9} {'total s':>9} {'us/call':>9} {'share':>7}\n")
+        for stage in PIPELINE_STAGES:
+            calls = stages[stage + "_calls"]
+            per_call = stages[stage] / calls * 1e6 if calls else 0
+            out.write(f"  {stage:<8} {calls:>9} {stages[stage]:>9.3f} {per_call:>9.1f} {stages[stage] / total:>7.1%}\n")
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if profiles:
+            stats = pstats.Stats(*profiles, stream=out)
+            stats.dump_stats(self.path + ".pstats.tmp")
+            os.replace(self.path + ".pstats.tmp", self.path + ".pstats")
+            stats.strip_dirs()
+            for key in ("cumulative", "tottime"):
+                out.write(f"\ncProfile: top {PROFILE_TOP} by {key}\n")
+                stats.sort_stats(key).print_stats(PROFILE_TOP)
+
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        growth = snapshot.filter_traces(ignore).compare_to(self.snapshot.filter_traces(ignore), "lineno")
+        out.write(f"\ntracemalloc: top {PROFILE_TOP} allocation sites by growth\n")
+        for stat in growth[:PROFILE_TOP]:
+            out.write(f"  {stat}\n")
+
+        with open(self.path + ".txt.tmp", "w") as f:
+            f.write(out.getvalue())
+        os.replace(self.path + ".txt.tmp", self.path + ".txt")
+
+
+# Running (or not yet fully detached) capture; message threads check it once
+# per message. PROFILE_LOCK is held from request_profile() until the report
+# is written, like RELOAD_LOCK for reloads.
+PROFILE = None
+PROFILE_LOCK = threading.Lock()
+PROFILE_GRACE = 5.0
+PROFILE_MAX_SECONDS = 600
+PROFILE_TOP = 40
+_profile_signalled = False
+
+
+def request_profile(seconds, reason):
+    """
+    Start a profile capture; housekeeping writes the report when it ends.
+    Returns the session, or None if a capture is already running.
+    """
+    global PROFILE
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return None
+    PROFILE = ProfileSession(seconds, reason)
+    LOG.info("profile", f"Profiling for {seconds:g}s ({reason}) -> {PROFILE.path}.txt",
+             seconds=seconds, reason=reason, path=PROFILE.path + ".txt")
+    return PROFILE
+
+
+# Set by SIGTERM; the main loop then shuts down cleanly
+_terminate_signalled = False
+
+
+def on_terminate_signal(signum, frame):
+    """SIGTERM (docker stop): leave the shutdown to the main loop, like SIGUSR1."""
+    global _terminate_signalled
+    _terminate_signalled = True
+
+
+def shutdown(client):
+    """Stop taking messages, then flush buffered InfluxDB lines (or spool them)."""
+    LOG.info("shutdown", "Shutting down...")
+    client.disconnect()
+    client.loop_stop()
+    if INFLUX is not None:
+        INFLUX.close()
+    LOG.flush()
+
+
+def on_profile_signal(signum, frame):
+    """SIGUSR1: leave the capture to housekeeping (taking locks here could deadlock)."""
+    global _profile_signalled
+    _profile_signalled = True
+
+
+def check_profile(now):
+    """Write the running capture once it is over, and forget it once every thread detached."""
+    global PROFILE, _profile_signalled
+    if _profile_signalled:
+        _profile_signalled = False
+        if request_profile(PROFILE_SECONDS, "SIGUSR1") is None:
+            LOG.warning("profile", "Profile capture already running, SIGUSR1 ignored")
+    session = PROFILE
+    if session is None or now < session.deadline:
+        return
+    if not session.written and (session.idle() or now >= session.deadline + PROFILE_GRACE):
+        try:
+            session.finish()
+            LOG.info("profile", f"Profile written to {session.path}.txt", path=session.path + ".txt")
+        except Exception as e:
+            LOG.warning("profile", f"Failed to write profile {session.path}: {e}", error=str(e))
+        finally:
+            PROFILE_LOCK.release()
+    # A new capture may have replaced it meanwhile; only clear our own
+    if session.written and session.idle() and PROFILE_LOCK.acquire(blocking=False):
+        try:
+            if PROFILE is session:
+                PROFILE = None
+        finally:
+            PROFILE_LOCK.release()
+
+
+def replay_spool(client, now):
+    """Hand spooled records back to the sink at up to SPOOL_RATE per second."""
+    global _spool_last_drain
+    limit = min(int((now - _spool_last_drain) * SPOOL_RATE), SPOOL_RATE)
+    if limit <= 0:
+        return
+    _spool_last_drain = now
+    if not SPOOL.depth():
+        return
+    if INFLUX is not None:
+        # Only top up a healthy writer so replay never crowds out live data; while
+        # InfluxDB is down, live batches probe it (replayed ones would just be
+        # spooled again, out of order and counted twice)
+        if not INFLUX.healthy:
+            return
+        records = SPOOL.pop(min(limit, max(INFLUX.batch - INFLUX.depth(), 0)))
+        INFLUX.write_lines(records)
+        STATS.inc("spool_replayed", len(records))
+        return
+    if not client.is_connected():
+        return
+    records = SPOOL.pop(limit)
+    for i, record in enumerate(records):
+        topic, payload = record.split("\t", 1)
+        if client.publish(topic, payload, retain=False).rc != mqtt.MQTT_ERR_SUCCESS:
+            SPOOL.append(records[i:])  # Lost the broker mid-replay
+            break
+        STATS.inc("spool_replayed")
+
+
+def housekeeping(client, now):
+    """Periodic work run from the main thread while paho handles the network."""
+    global _stats_last_report, _next_api_refresh, _override_mtime, _next_metrics_sample
+    mtime = override_mtime()
+    if mtime != _override_mtime and request_reload(False, "device-overrides.json changed"):
+        _override_mtime = mtime
+    if (REFRESH_INTERVAL and not REGISTRY_TOPIC and now >= _next_api_refresh
+            and request_reload(True, "periodic API refresh")):
+        _next_api_refresh = now + REFRESH_INTERVAL
+    if DEDUP is not None:
+        for reading in DEDUP.expire(DEDUP.clock()):
+            emit_reading(client, reading)
+    if AGGREGATOR is not None:
+        for summary in AGGREGATOR.flush(AGGREGATOR.clock()):
+            output_reading(client, summary)
+    if SPOOL is not None:
+        replay_spool(client, now)
+    if STATS_INTERVAL and now - _stats_last_report >= STATS_INTERVAL:
+        log_stats(now - _stats_last_report)
+        _stats_last_report = now
+    check_profile(now)
+    if METRICS_PORT and now >= _next_metrics_sample:
+        METRICS_HISTORY.append((now, STATS.snapshot(), GATEWAY_STATS.snapshot()))
+        _next_metrics_sample = now + METRICS_SAMPLE
 
 
 def on_connect(client, userdata, flags, rc):
     """Callback when client connects to MQTT broker."""
     if rc == 0:
-        print(f"Connected to MQTT broker at {BROKER}:{PORT}")
-        print(f"Showsite: {SHOWSITE}")
-        print(f"Decoder node: {DECODER_NODE}")
-        print()
+        LOG.info("mqtt", f"Connected to MQTT broker at {BROKER}:{PORT} as {CLIENT_ID} "
+                         f"(showsite {SHOWSITE}, node {DECODER_NODE}"
+                         + (f", {shard_label()})" if SHARD_MODE != "none" else ")"),
+                 broker=f"{BROKER}:{PORT}", client_id=CLIENT_ID, showsite=SHOWSITE,
+                 node=DECODER_NODE, shard=shard_label())
         for topic in SUB_TOPICS:
+            if SHARD_MODE == "shared":
+                topic = f"$share/{SHARE_GROUP}/{topic}"
             client.subscribe(topic)
-            print(f"Subscribed to: {topic}")
-        print()
+            LOG.info("mqtt", f"Subscribed to: {topic}", topic=topic)
+        if REGISTRY_TOPIC:
+            client.subscribe(REGISTRY_TOPIC, qos=1)
+            LOG.info("mqtt", f"Device registry: {REGISTRY_TOPIC}", topic=REGISTRY_TOPIC)
     else:
-        print(f"Failed to connect, return code {rc}")
+        LOG.warning("mqtt", f"Failed to connect, return code {rc}", rc=rc)
 
 
 def on_disconnect(client, userdata, rc):
     """Callback when client disconnects."""
     if rc != 0:
-        print(f"Unexpected disconnect (code {rc}), reconnecting...")
+        LOG.warning("mqtt", f"Unexpected disconnect (code {rc}), reconnecting...", rc=rc)
 
 
 def main():
     """Main entry point."""
+    global POOL, INFLUX, SPOOL, _override_mtime
+    if "--telegraf-json-config" in sys.argv[1:]:
+        print(telegraf_json_config(), end="")
+        return
+
     print("=" * 60)
     print(f"DPX BLE Decoder v{VERSION}")
     print("=" * 60)
     print()
+
+    problem = check_shard_config()
+    if problem:
+        print(f"Invalid shard configuration: {problem}")
+        sys.exit(1)
     
-    # Load device mappings from API
-    load_devices()
+    # Start on the last saved device map if there is one and refresh from the
+    # API in the background; otherwise wait for the API as before
+    _override_mtime = override_mtime()
+    if load_snapshot():
+        request_reload(True, "startup")
+    else:
+        load_devices(refresh_api=not REGISTRY_TOPIC)
+    LOG.flush()  # device list before the rest of the banner
     print()
+
+    # SIGHUP: refresh devices now (e.g. docker kill -s HUP ble-decoder)
+    signal.signal(signal.SIGHUP, lambda signum, frame: request_reload(True, "SIGHUP"))
+    # SIGUSR1: profile for DECODER_PROFILE_SECONDS (docker kill -s USR1 ble-decoder)
+    signal.signal(signal.SIGUSR1, on_profile_signal)
+    # SIGTERM (docker stop/restart): flush or spool buffered output before exiting
+    signal.signal(signal.SIGTERM, on_terminate_signal)
     
     # Create MQTT client (compatible with paho-mqtt 1.6.1)
-    client = mqtt.Client(client_id="dpx_ops_decoder")
+    client = mqtt.Client(client_id=CLIENT_ID)
     client.on_connect = on_connect
     client.on_message = on_message
     client.on_disconnect = on_disconnect
+    if REGISTRY_TOPIC:
+        client.message_callback_add(REGISTRY_TOPIC, on_registry)
+
+    # Spool only output that carries its own timestamp: scalar payloads are
+    # stamped by Telegraf on receipt, so replaying them later would misdate them
+    if SPOOL_MAX_MB > 0 and (SINK == "influx" or OUTPUT_MODE == "json"):
+        SPOOL = Spool(os.path.join(SPOOL_DIR, SINK), int(SPOOL_MAX_MB * 1024 * 1024))
+        print(f"Spool: {SPOOL.directory} (cap {SPOOL_MAX_MB:g} MB, replay {SPOOL_RATE}/s, "
+              f"{SPOOL.depth()} records pending)")
+    elif SPOOL_MAX_MB > 0:
+        print("Spool: off (scalar MQTT output has no timestamps; use DECODER_OUTPUT=json or DECODER_SINK=influx)")
+
+    if SINK == "influx":
+        INFLUX = InfluxWriter(INFLUX_URL, INFLUX_TOKEN, INFLUX_ORG, INFLUX_BUCKET,
+                              INFLUX_BATCH, INFLUX_FLUSH, INFLUX_BUFFER)
+        INFLUX.start()
+        print(f"Sink: InfluxDB {INFLUX_URL} bucket {INFLUX_BUCKET} (batch {INFLUX_BATCH}, flush {INFLUX_FLUSH}s)")
+
+    # Decode off the network thread so slow messages don't stall socket reads
+    if WORKERS > 0:
+        POOL = WorkerPool(client, WORKERS, QUEUE_MAX, OVERFLOW)
+        POOL.start()
+        print(f"Decode workers: {WORKERS} (queue {QUEUE_MAX}/worker, overflow: {OVERFLOW})")
+    if METRICS_PORT:
+        try:
+            host, port = start_metrics_server(METRICS_PORT).server_address[:2]
+            print(f"Metrics: http://{host}:{port}/metrics (and /metrics.json"
+                  + (", POST /profile)" if PROFILE_HTTP else ")"))
+        except OSError as e:
+            print(f"Warning: Metrics endpoint not started on {METRICS_BIND}:{METRICS_PORT}: {e}")
+    print(f"JSON parser: {JSON_BACKEND}")
+    print(f"Logging: {LOG_FORMAT}, readings: {LOG_READINGS}"
+          + (f" (one per device per {LOG_SAMPLE:g}s)" if LOG_READINGS == "sample" else "")
+          + (", debug on" if DEBUG else ""))
+    print(f"Profiling: SIGUSR1 for {PROFILE_SECONDS:g}s -> {PROFILE_DIR}/"
+          + (" (also POST /profile)" if PROFILE_HTTP and METRICS_PORT else ""))
     
     # Connect and start loop
     try:
         client.connect(BROKER, PORT, 60)
         print("Starting decoder loop...")
-        print(f"Output: {SHOWSITE}/{DECODER_NODE}/{{source}}/{{room}}/{{device}}/{{mac}}/{{metric}}")
+        if INFLUX is not None:
+            print(f"Output: InfluxDB {INFLUX_URL}")
+        elif OUTPUT_MODE == "json":
+            print(f"Output (json): {SHOWSITE}/{JSON_NODE}/{{source}}/{{room}}/{{device}}/{{mac}}")
+        else:
+            print(f"Output: {SHOWSITE}/{DECODER_NODE}/{{source}}/{{room}}/{{device}}/{{mac}}/{{metric}}")
         print()
-        client.loop_forever()
+        # paho runs the network loop (and on_message) on its own thread;
+        # the main thread is left for periodic housekeeping
+        client.loop_start()
+        while not _terminate_signalled:
+            time.sleep(HOUSEKEEPING_TICK)
+            housekeeping(client, time.monotonic())
+        shutdown(client)
     except KeyboardInterrupt:
-        print("\nShutting down...")
-        client.disconnect()
+        shutdown(client)
     except Exception as e:
+        LOG.flush()
         print(f"Fatal error: {e}")
         sys.exit(1)
 
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Decoder Traffic Recorder / Replay
+Records gateway traffic on the decoder's SUB_TOPICS to a capture file and
+replays it into ble_decoder.py at recorded speed, N times faster or as fast as
+possible - in-process (no broker) or through a local mosquitto - reporting
+sustained throughput, latency percentiles and whether the decoder output
+matches a saved baseline.
+
+Capture file: gzip stream of b"BLECAP1\\n" followed by one record per message:
+    <f8 seconds since first message> <u2 topic length> <u4 payload length> topic payload
+
+Usage:
+  python3 scripts/decoder_replay.py record show.cap --duration 600
+  python3 scripts/decoder_replay.py info show.cap
+  python3 scripts/decoder_replay.py replay show.cap                       # in-process, max speed
+  python3 scripts/decoder_replay.py replay show.cap --speed 1             # recorded pace
+  python3 scripts/decoder_replay.py replay show.cap --save-baseline show.out
+  python3 scripts/decoder_replay.py replay show.cap --baseline show.out   # exit 1 on mismatch
+  python3 scripts/decoder_replay.py replay show.cap --target broker --speed 10
+
+In-process replay uses the device snapshot (data/device-snapshot.json) plus
+device-overrides.json, and the decoder settings from the environment
+(DECODER_OUTPUT, DECODER_DEDUP_WINDOW...). Messages are decoded inline on the
+replay thread, so latency is due time -> on_message done per message. The
+dedup, deadband and aggregation windows run on capture time (seconds since the
+first message) instead of the live clocks, so the output is the same at any
+--speed and start time.
+Broker replay publishes to the broker a running decoder listens on and times
+each output from the last input published for the same MAC.
+"""
+
+import argparse
+import contextlib
+import gzip
+import json
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ble_decoder  # noqa: E402
+
+CAPTURE_MAGIC = b"BLECAP1\n"
+RECORD = struct.Struct("<dHI")
+
+
+# ============================================================================
+# Capture files
+# ============================================================================
+
+class CaptureWriter:
+    """Appends (seconds, topic, payload) records to a gzip'd capture file."""
+
+    def __init__(self, path):
+        self.file = gzip.open(path, "wb", compresslevel=6)
+        self.file.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def write(self, offset, topic, payload):
+        topic = topic.encode()
+        self.file.write(RECORD.pack(offset, len(topic), len(payload)) + topic + payload)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """All records of a capture file as a list of (seconds, topic, payload)."""
+    records = []
+    with gzip.open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path}: not a decoder capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            offset, topic_len, payload_len = RECORD.unpack(header)
+            topic = f.read(topic_len).decode()
+            records.append((offset, topic, f.read(payload_len)))
+    return records
+
+
+def write_capture(path, records):
+    writer = CaptureWriter(path)
+    for offset, topic, payload in records:
+        writer.write(offset, topic, payload)
+    writer.close()
+
+
+# ============================================================================
+# Helpers
+# ============================================================================
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    """Nearest-rank percentiles of `values` as {"p50": ..., ...}."""
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    return {
+        f"p{point:g}": ordered[min(len(ordered) - 1, max(0, math.ceil(point / 100 * len(ordered)) - 1))]
+        for point in points
+    }
+
+
+def output_payload(payload):
+    """Payload bytes as paho would send them (numbers are published as their str())."""
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    return str(payload).encode()
+
+
+def normalize_output(topic, payload):
+    """Comparable form of one output: JSON documents lose their publish-time "ts"."""
+    if topic.startswith(f"{ble_decoder.SHOWSITE}/{ble_decoder.JSON_NODE}/"):
+        document = json.loads(payload)
+        document.pop("ts", None)
+        return json.dumps(document, sort_keys=True)
+    return payload.decode()
+
+
+def compare_outputs(outputs, baseline):
+    """
+    Per-topic comparison of two output lists [(seconds, topic, payload)].
+    Each topic's payload sequence must match in order; streams may interleave
+    differently. Returns a list of human-readable differences (empty if equal).
+    """
+    def streams(records):
+        grouped = defaultdict(list)
+        for _, topic, payload in records:
+            grouped[topic].append(normalize_output(topic, payload))
+        return grouped
+
+    got, expected = streams(outputs), streams(baseline)
+    differences = []
+    for topic in sorted(expected.keys() - got.keys()):
+        differences.append(f"missing {topic} ({len(expected[topic])} messages)")
+    for topic in sorted(got.keys() - expected.keys()):
+        differences.append(f"unexpected {topic} ({len(got[topic])} messages)")
+    for topic in sorted(got.keys() & expected.keys()):
+        a, b = got[topic], expected[topic]
+        if a != b:
+            index = next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            differences.append(
+                f"{topic}: {len(a)} vs {len(b)} messages, first difference at #{index}: "
+                f"{a[index] if index < len(a) else '<none>'} != {b[index] if index < len(b) else '<none>'}"
+            )
+    return differences
+
+
+def input_mac(topic, payload):
+    """MAC an input message is for (from the topic, or the "id" field in extDecoder mode)."""
+    mac = ble_decoder.topic_mac(topic)
+    if mac is None:
+        try:
+            mac = json.loads(payload).get("id", "").replace(":", "").upper()
+        except (ValueError, AttributeError):
+            return None
+    return mac
+
+
+# ============================================================================
+# Record
+# ============================================================================
+
+def cmd_record(args):
+    """Write everything on the decoder's input topics to a capture file."""
+    topics = args.topic or ble_decoder.SUB_TOPICS
+    writer = CaptureWriter(args.capture)
+    started = None
+
+    def on_connect(client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Failed to connect, return code {rc}")
+            return
+        for topic in topics:
+            client.subscribe(topic)
+        print(f"Recording {', '.join(topics)} from {args.broker}:{args.port} -> {args.capture}")
+
+    def on_message(client, userdata, msg):
+        nonlocal started
+        now = time.monotonic()
+        if started is None:
+            started = now
+        writer.write(now - started, msg.topic, msg.payload)
+
+    client = mqtt.Client(client_id=f"decoder_recorder_{os.getpid()}")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+    deadline = time.monotonic() + args.duration if args.duration else math.inf
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(min(10, max(deadline - time.monotonic(), 0)))
+            print(f"{time.strftime('%H:%M:%S')} {writer.count} messages recorded")
+    except KeyboardInterrupt:
+        pass
+    client.disconnect()
+    client.loop_stop()
+    writer.close()
+    print(f"Saved {writer.count} messages to {args.capture}")
+
+
+def cmd_info(args):
+    """Summarize a capture: size, duration, rate and busiest topics."""
+    records = read_capture(args.capture)
+    if not records:
+        print(f"{args.capture}: empty")
+        return
+    duration = records[-1][0]
+    per_gateway = defaultdict(int)
+    for _, topic, _ in records:
+        per_gateway[topic.rsplit("/BTtoMQTT/", 1)[0]] += 1
+    payload_bytes = sum(len(payload) for _, _, payload in records)
+    print(f"{args.capture}: {len(records)} messages over {duration:.1f}s "
+          f"({len(records) / max(duration, 1e-9):.0f}/s), {payload_bytes / len(records):.0f} B/payload, "
+          f"{os.path.getsize(args.capture) / len(records):.1f} B/message on disk")
+    for gateway, count in sorted(per_gateway.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {gateway:<40} {count:>9}")
+
+
+# ============================================================================
+# Replay
+# ============================================================================
+
+class RecordingClient:
+    """Stands in for paho in-process: keeps every publish as (seconds, topic, payload)."""
+
+    class Result:
+        rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __init__(self, started):
+        self.started = started
+        self.outputs = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.outputs.append((time.perf_counter() - self.started, topic, output_payload(payload)))
+        return self.Result
+
+    def is_connected(self):
+        return True
+
+
+class Message:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def load_device_map(args):
+    """Install the replay device map (snapshot + overrides) into ble_decoder."""
+    ble_decoder.SNAPSHOT_FILE = args.devices
+    ble_decoder.OVERRIDE_FILE = args.overrides
+    if not ble_decoder.load_snapshot():
+        ble_decoder.load_devices(refresh_api=False)
+    return len(ble_decoder.DEVICES)
+
+
+class ReplayClock:
+    """Capture time (seconds since the first message) standing in for the decoder's clocks."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def use_clock(clock):
+    """Run ble_decoder's dedup, deadband and aggregation windows on `clock`."""
+    for stage in (ble_decoder.DEDUP, ble_decoder.DEADBAND_FILTER):
+        if stage is not None:
+            stage.clock = clock
+    if ble_decoder.AGGREGATOR is not None:
+        ble_decoder.AGGREGATOR.set_clock(clock)
+
+
+def replay_inprocess(records, speed):
+    """Feed records to ble_decoder.on_message on this thread; returns (outputs, latencies, seconds)."""
+    clock = ReplayClock()
+    use_clock(clock)
+    started = time.perf_counter()
+    client = RecordingClient(started)
+    latencies = []
+    on_message = ble_decoder.on_message
+    for offset, topic, payload in records:
+        # Release windows that closed before this message, at capture time
+        clock.now = offset
+        flush_held(client, offset)
+        due = started + offset / speed if speed else time.perf_counter()
+        now = time.perf_counter()
+        if due > now:
+            time.sleep(due - now)
+            due = time.perf_counter()  # Ahead of schedule: oversleeping is not decoder latency
+        on_message(client, None, Message(topic, payload))
+        done = time.perf_counter()
+        latencies.append(done - due)
+    flush_held(client, None)
+    return client.outputs, latencies, time.perf_counter() - started
+
+
+def flush_held(client, now):
+    """
+    Release readings held by dedup/aggregation at capture time `now`, as the
+    decoder's housekeeping does; None ends the replay and closes every window.
+    """
+    if ble_decoder.DEDUP is not None:
+        for reading in ble_decoder.DEDUP.expire(math.inf if now is None else now):
+            ble_decoder.emit_reading(client, reading)
+    if ble_decoder.AGGREGATOR is not None:
+        if now is None:
+            now = ble_decoder.AGGREGATOR.window_end  # End of replay: close the open window
+        for summary in ble_decoder.AGGREGATOR.flush(now):
+            ble_decoder.output_reading(client, summary)
+
+
+def replay_broker(records, speed, args):
+    """Publish records to the broker and collect the running decoder's output."""
+    lock = threading.Lock()
+    outputs = []
+    latencies = []
+    last_sent = {}
+    output_topics = [f"{ble_decoder.SHOWSITE}/{ble_decoder.DECODER_NODE}/#",
+                     f"{ble_decoder.SHOWSITE}/{ble_decoder.JSON_NODE}/#"]
+    subscribed = threading.Event()
+    started = time.perf_counter()
+
+    def on_connect(client, userdata, flags, rc):
+        for topic in output_topics:
+            client.subscribe(topic)
+        subscribed.set()
+
+    def on_message(client, userdata, msg):
+        now = time.perf_counter()
+        parts = msg.topic.split("/")
+        sent = last_sent.get(parts[5]) if len(parts) > 5 else None
+        with lock:
+            outputs.append((now - started, msg.topic, msg.payload))
+            if sent is not None:
+                latencies.append(now - sent)
+
+    client = mqtt.Client(client_id=f"decoder_replay_{os.getpid()}")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+    if not subscribed.wait(10):
+        raise RuntimeError(f"No connection to {args.broker}:{args.port}")
+
+    begin = time.perf_counter()
+    for offset, topic, payload in records:
+        if speed:
+            delay = begin + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        mac = input_mac(topic, payload)
+        if mac:
+            last_sent[mac] = time.perf_counter()
+        client.publish(topic, payload)
+    sent_done = time.perf_counter()
+
+    # Wait for the decoder to go quiet (or give up after --drain seconds)
+    deadline = sent_done + args.drain
+    seen = -1
+    while time.perf_counter() < deadline:
+        time.sleep(args.settle)
+        with lock:
+            count = len(outputs)
+        if count == seen:
+            break
+        seen = count
+    client.disconnect()
+    client.loop_stop()
+    with lock:
+        last_output = started + outputs[-1][0] if outputs else sent_done
+        return list(outputs), list(latencies), max(last_output, sent_done) - begin
+
+
+def cmd_replay(args):
+    """Replay a capture and report throughput, latency and baseline equivalence."""
+    records = read_capture(args.capture)
+    if not records:
+        print(f"{args.capture}: empty")
+        return 1
+    speed = 0 if args.speed == "max" else float(args.speed)
+    duration = records[-1][0]
+
+    if args.target == "inprocess":
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            devices = load_device_map(args)
+            before = ble_decoder.STATS.snapshot()
+            outputs, latencies, elapsed = replay_inprocess(records, speed)
+            ble_decoder.LOG.flush()
+        after = ble_decoder.STATS.snapshot()
+        counters = {name: after[name] - before[name] for name in after}
+        target = f"in-process ({devices} devices, output: {ble_decoder.OUTPUT_MODE})"
+    else:
+        outputs, latencies, elapsed = replay_broker(records, speed, args)
+        counters = None
+        target = f"broker {args.broker}:{args.port}"
+
+    results = {
+        "capture": args.capture,
+        "target": args.target,
+        "speed": args.speed,
+        "messages": len(records),
+        "capture_seconds": round(duration, 3),
+        "replay_seconds": round(elapsed, 3),
+        "messages_per_second": round(len(records) / elapsed, 1),
+        "outputs": len(outputs),
+        "latency_us": {name: round(value * 1e6, 1) for name, value in percentiles(latencies).items()},
+    }
+    if latencies:
+        results["latency_us"]["max"] = round(max(latencies) * 1e6, 1)
+    if counters is not None:
+        results["counters"] = counters
+
+    print(f"Replayed {len(records)} messages ({duration:.1f}s captured) into {target}")
+    print(f"  {elapsed:.2f}s at speed {args.speed}: {results['messages_per_second']:.0f} msg/s"
+          + (f" ({duration / elapsed:.1f}x recorded pace)" if duration else ""))
+    print("  latency " + "  ".join(f"{name} {value:.0f}us" for name, value in results["latency_us"].items()))
+    print(f"  {len(outputs)} output messages on {len({topic for _, topic, _ in outputs})} topics")
+    if counters is not None:
+        print("  " + ", ".join(f"{name}={counters[name]}" for name in
+                               ("decoded", "dropped_unknown", "dropped_no_data", "duplicates", "errors")))
+
+    status = 0
+    if args.save_baseline:
+        write_capture(args.save_baseline, outputs)
+        print(f"  Saved {len(outputs)} outputs as baseline {args.save_baseline}")
+    if args.baseline:
+        differences = compare_outputs(outputs, read_capture(args.baseline))
+        results["baseline"] = {"file": args.baseline, "identical": not differences,
+                               "differences": len(differences)}
+        if differences:
+            print(f"  Output differs from {args.baseline} ({len(differences)} topics):")
+            for line in differences[:20]:
+                print(f"    {line}")
+            status = 1
+        else:
+            print(f"  Output identical to {args.baseline}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--broker", default=ble_decoder.BROKER)
+    parser.add_argument("--port", type=int, default=ble_decoder.PORT)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("record", help="record the decoder's input topics")
+    p.add_argument("capture")
+    p.add_argument("--duration", type=float, default=0, help="seconds (0 = until Ctrl-C)")
+    p.add_argument("--topic", action="append", help="topic filter (repeatable; default: decoder SUB_TOPICS)")
+    p.set_defaults(func=cmd_record)
+
+    p = sub.add_parser("info", help="summarize a capture file")
+    p.add_argument("capture")
+    p.set_defaults(func=cmd_info)
+
+    p = sub.add_parser("replay", help="replay a capture into the decoder")
+    p.add_argument("capture")
+    p.add_argument("--speed", default="max", help="1 = recorded pace, N = N times faster, max = no pacing")
+    p.add_argument("--target", choices=["inprocess", "broker"], default="inprocess")
+    p.add_argument("--devices", default=ble_decoder.SNAPSHOT_FILE, help="device snapshot (in-process)")
+    p.add_argument("--overrides", default=ble_decoder.OVERRIDE_FILE, help="device-overrides.json (in-process)")
+    p.add_argument("--baseline", help="compare output with this saved baseline")
+    p.add_argument("--save-baseline", help="save this run's output as a baseline")
+    p.add_argument("--json", help="also write the results to this JSON file")
+    p.add_argument("--drain", type=float, default=30, help="broker: max seconds to wait for output after the last publish")
+    p.add_argument("--settle", type=float, default=2, help="broker: output counted complete after this many quiet seconds")
+    p.set_defaults(func=cmd_replay)
+
+    args = parser.parse_args()
+    if getattr(args, "speed", "max") != "max":
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("--speed must be a positive number or 'max'")
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
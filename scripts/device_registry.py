@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Device Registry - event-driven Govee device table
+Follows govee2mqtt's Home Assistant discovery messages instead of polling its
+HTTP API, applies local overrides (same rules as manage-devices.py merge) and
+publishes the merged table as one retained MQTT message.
+
+Input:  {discovery_prefix}/+/+/config   (retained; empty payload = entity removed)
+Output: {site}/dpx_ops_registry/devices  (retained)
+        {"updated_at": <epoch s>, "devices": {"<MAC suffix>": [name, room, sku], ...}}
+
+Consumers: ble_decoder.py (DECODER_REGISTRY_TOPIC) and
+           manage-devices.py update-map --from-registry
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+# Read version from VERSION file (parent dir for local, same dir in container)
+VERSION_FILE_PARENT = Path(__file__).parent.parent / "VERSION"
+VERSION_FILE_SAME = Path(__file__).parent / "VERSION"
+try:
+    if VERSION_FILE_PARENT.exists():
+        VERSION = VERSION_FILE_PARENT.read_text().strip()
+    elif VERSION_FILE_SAME.exists():
+        VERSION = VERSION_FILE_SAME.read_text().strip()
+    else:
+        VERSION = "unknown"
+except:
+    VERSION = "unknown"
+
+# Configuration
+BROKER = os.getenv("BROKER", "localhost")
+PORT = int(os.getenv("BROKER_PORT", "1883"))
+SHOWSITE = os.getenv("SHOWSITE_NAME", "demo_showsite")
+DISCOVERY_PREFIX = os.getenv("GOVEE_DISCOVERY_PREFIX", "homeassistant")
+REGISTRY_TOPIC = os.getenv("REGISTRY_TOPIC", f"{SHOWSITE}/dpx_ops_registry/devices")
+OVERRIDE_FILE = os.path.join(os.path.dirname(__file__), "telegraf", "conf.d", "device-overrides.json")
+
+# Coalesce bursts (govee2mqtt republishes every entity on startup) into one publish:
+# the table goes out once it has been unchanged for PUBLISH_DELAY seconds
+PUBLISH_DELAY = float(os.getenv("REGISTRY_PUBLISH_DELAY", "2"))
+# Nothing is published before the first discovery message arrives, or until this
+# many seconds after startup if govee2mqtt stays silent (consumers would otherwise
+# replace their device map with an empty or overrides-only table)
+STARTUP_GRACE = float(os.getenv("REGISTRY_STARTUP_GRACE", "120"))
+
+# govee2mqtt ids are 16 hex chars (e.g. sensor-XXXXA4C138F85A9C-sensortemperature);
+# devices are keyed by the last 12 like everywhere else in the stack
+DEVICE_ID_RE = re.compile(r"[0-9A-Fa-f]{12,16}")
+
+
+# ============================================================================
+# Registry
+# ============================================================================
+
+class Registry:
+    """
+    Device table built from discovery messages, one entry per MAC suffix.
+
+    Several discovery entities (temperature, humidity, battery...) belong to
+    each device; the device is dropped once all of them are removed.
+    """
+
+    def __init__(self):
+        self.devices = {}    # mac -> {"name", "room", "sku"} as reported by govee2mqtt
+        self.entities = {}   # discovery topic -> mac
+        self.overrides = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.changed_at = None  # monotonic time of the last change, for the debounce
+        self.discovered = False  # any discovery config seen yet
+        self.last_merged = None
+
+    def touch(self):
+        """Mark the table changed (call with the lock held)."""
+        self.dirty = True
+        self.changed_at = time.monotonic()
+
+    def on_discovery(self, topic, payload):
+        """Apply one discovery config message; returns True if the table changed."""
+        with self.lock:
+            if not payload:
+                mac = self.entities.pop(topic, None)
+                if mac is None or mac in self.entities.values():
+                    return False
+                del self.devices[mac]
+                self.touch()
+                return True
+
+            device = parse_discovery(payload)
+            if device is None:
+                return False
+            mac, info = device
+            self.entities[topic] = mac
+            self.discovered = True
+            if self.devices.get(mac) == info:
+                return False
+            self.devices[mac] = info
+            self.touch()
+            return True
+
+    def set_overrides(self, overrides):
+        with self.lock:
+            self.overrides = overrides
+            self.touch()
+
+    def ready(self, now, started_at):
+        """True once the table is worth publishing: quiet for PUBLISH_DELAY after
+        a change, and discovery seen (or STARTUP_GRACE passed without any)."""
+        if not self.dirty or now - self.changed_at < PUBLISH_DELAY:
+            return False
+        return self.discovered or now - started_at >= STARTUP_GRACE
+
+    def merged(self):
+        """Device table with overrides applied (same precedence as merge_devices)."""
+        with self.lock:
+            self.dirty = False
+            merged = {
+                mac: [info["name"], info["room"], info["sku"]]
+                for mac, info in self.devices.items()
+            }
+            for mac, override in self.overrides.items():
+                if mac in merged:
+                    entry = merged[mac]
+                    entry[0] = override.get("name", entry[0])
+                    entry[1] = override.get("room", entry[1])
+                    entry[2] = override.get("sku", entry[2])
+                elif "name" in override:
+                    # Override-only device (not known to govee2mqtt)
+                    merged[mac] = [override["name"], override.get("room", "unassigned"),
+                                   override.get("sku", "unknown")]
+            return merged
+
+
+def parse_discovery(payload):
+    """Extract (mac, {"name", "room", "sku"}) from a discovery config, or None."""
+    try:
+        config = json.loads(payload)
+    except ValueError:
+        return None
+    device = config.get("device") or {}
+    name = device.get("name")
+    if not name:
+        return None
+
+    candidates = list(device.get("identifiers") or []) + [config.get("unique_id") or ""]
+    mac = None
+    for candidate in candidates:
+        match = DEVICE_ID_RE.search(str(candidate).replace(":", ""))
+        if match:
+            mac = match.group(0).upper()[-12:]
+            break
+    if mac is None:
+        return None
+
+    return mac, {
+        "name": name.lower().replace(" ", "_"),
+        "room": (device.get("suggested_area") or "unassigned").lower().replace(" ", "_"),
+        "sku": device.get("model") or "unknown",
+    }
+
+
+def load_overrides():
+    """Read device-overrides.json keyed by MAC suffix (comment keys skipped)."""
+    if not os.path.exists(OVERRIDE_FILE):
+        return {}
+    try:
+        with open(OVERRIDE_FILE) as f:
+            data = json.load(f)
+        return {k[-12:].upper(): v for k, v in data.items() if not k.startswith("_")}
+    except Exception as e:
+        print(f"Warning: Failed to load overrides: {e}")
+        return {}
+
+
+def override_mtime():
+    try:
+        return os.stat(OVERRIDE_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def publish_registry(client, registry):
+    """Publish the merged table as a retained message if it changed."""
+    merged = registry.merged()
+    if merged == registry.last_merged:
+        return
+    registry.last_merged = merged
+    payload = json.dumps({"updated_at": time.time(), "devices": merged}, separators=(",", ":"))
+    client.publish(REGISTRY_TOPIC, payload, qos=1, retain=True)
+    print(f"{time.strftime('%H:%M:%S')} Published registry: {len(merged)} devices -> {REGISTRY_TOPIC}")
+
+
+# ============================================================================
+# MQTT
+# ============================================================================
+
+def main():
+    """Main entry point."""
+    print("=" * 60)
+    print(f"DPX Device Registry v{VERSION}")
+    print("=" * 60)
+    print()
+
+    registry = Registry()
+    started_at = time.monotonic()
+    registry.set_overrides(load_overrides())
+    last_override_mtime = override_mtime()
+    discovery_topic = f"{DISCOVERY_PREFIX}/+/+/config"
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            print(f"Connected to MQTT broker at {BROKER}:{PORT}")
+            client.subscribe(discovery_topic)
+            print(f"Subscribed to: {discovery_topic}")
+            print(f"Publishing to: {REGISTRY_TOPIC}")
+            print()
+        else:
+            print(f"Failed to connect, return code {rc}")
+
+    def on_message(client, userdata, msg):
+        if registry.on_discovery(msg.topic, msg.payload):
+            print(f"{time.strftime('%H:%M:%S')} Discovery update: {msg.topic}")
+
+    client = mqtt.Client(client_id="dpx_ops_registry")
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    try:
+        client.connect(BROKER, PORT, 60)
+        client.loop_start()
+        while True:
+            time.sleep(0.5)
+            mtime = override_mtime()
+            if mtime != last_override_mtime:
+                last_override_mtime = mtime
+                registry.set_overrides(load_overrides())
+                print(f"{time.strftime('%H:%M:%S')} device-overrides.json changed")
+            if registry.ready(time.monotonic(), started_at):
+                publish_registry(client, registry)
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+        client.disconnect()
+        client.loop_stop()
+    except Exception as e:
+        print(f"Fatal error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
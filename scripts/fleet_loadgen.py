@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Synthetic Fleet Load Generator
+Simulates ESP32 gateways ({site}/{node}/BTtoMQTT/{MAC}) and a Theengs gateway
+(home/TheengsGateway/BTtoMQTT/{MAC}) relaying adverts from thousands of
+H5051/H5074/H5075 sensors, for sizing decoder hardware without a real fleet.
+
+Each sensor advertises every --interval seconds (with jitter) and is heard by
+its --coverage nearest gateways, each with its own RSSI and packet loss.
+Gateways either forward raw manufacturerdata or pre-decode it like
+OpenMQTTGateway/Theengs firmware (--decoding-gateways). Unknown iBeacons,
+other vendors' adverts and name-only scan responses are mixed in at
+--junk-rate messages/s. The fleet is derived from --seed, so the matching
+device-overrides.json is always the same for the same options.
+
+Usage:
+  python3 scripts/fleet_loadgen.py --sensors 2000 --gateways 100 --write-overrides /tmp/fleet-overrides.json
+  python3 scripts/fleet_loadgen.py --sensors 2000 --gateways 100 --duration 600     # publish to the broker
+  python3 scripts/fleet_loadgen.py --sensors 2000 --gateways 100 --duration 60 --capture fleet.cap
+  python3 scripts/decoder_replay.py replay fleet.cap --overrides /tmp/fleet-overrides.json
+
+To have a running decoder recognize the fleet, install the overrides file as
+telegraf/conf.d/device-overrides.json (the decoder reloads it on change) -
+override-only devices are added to the device map.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ble_decoder  # noqa: E402
+from decoder_replay import CaptureWriter  # noqa: E402
+
+# Model names as OpenMQTTGateway/Theengs report them
+MODEL_IDS = {"H5051": "H5051", "H5074": "H5074", "H5075": "H5072/H5075"}
+ADVERT_NAMES = {"H5051": "Govee_H5051_{}", "H5074": "Govee_H5074_{}", "H5075": "GVH5075_{}"}
+
+# Junk traffic the decoder has to discard: iBeacons, other vendors, scan responses
+JUNK_MANUFACTURER_DATA = [
+    "4c000215494e54454c4c495f524f434b535f48575075f2ffc2",  # iBeacon
+    "4c0010050b1c4f2a1e",                                  # Apple nearby
+    "060001092022b5b7e1b0b2a3c4d5e6f708",                  # Microsoft CDP
+    "7500420401806f",                                      # Samsung
+]
+
+
+# ============================================================================
+# Fleet
+# ============================================================================
+
+def field_range(code):
+    """(lowest, highest) raw value of a struct field type such as "<H" or "b"."""
+    bits = 8 * struct.calcsize(code)
+    if code[-1].islower():
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    return 0, (1 << bits) - 1
+
+
+def field_limits(field):
+    """(lowest, highest) decoded value a decoder spec field can carry (°F for fahrenheit fields)."""
+    def convert(raw):
+        value = (raw + field.get("add", 0)) / field.get("divide", 1)
+        return value * 9 / 5 + 32 if field.get("fahrenheit") else value
+
+    low, high = sorted(map(convert, field_range(field["type"])))
+    if "clamp" in field:
+        low, high = max(low, field["clamp"][0]), min(high, field["clamp"][1])
+    return low, high
+
+
+def encode_advert(spec, values):
+    """
+    Manufacturer data that `spec` (an ACTIVE_SPECS entry) decodes back to
+    `values` ({"temp_f", "humidity", "battery"}), within the field resolution.
+    Raises ValueError for a value the field cannot represent.
+    """
+    fields = spec["fields"]
+    size = max([spec.get("min_len", 0)]
+               + [field["offset"] + struct.calcsize(field["type"]) for field in fields.values()])
+    data = bytearray(size)
+    header = bytes.fromhex(spec.get("header", "88ec"))
+    data[:len(header)] = header
+    for name, field in fields.items():
+        value = values[name]
+        if field.get("fahrenheit"):
+            value = (value - 32) * 5 / 9
+        raw = round(value * field.get("divide", 1) - field.get("add", 0))
+        low, high = field_range(field["type"])
+        if not low <= raw <= high:
+            raise ValueError(f"{name}={values[name]} does not fit {field['type']} at offset {field['offset']}")
+        struct.pack_into(field["type"], data, field["offset"], raw)
+    return data.hex()
+
+
+def colon_mac(mac):
+    return ":".join(mac[i:i + 2] for i in range(0, 12, 2))
+
+
+# Where simulated readings start and how far they may drift, before limiting
+# them to what each model's layout can encode
+START_RANGES = {"temp_f": (64, 80), "humidity": (30, 60)}
+WALK_RANGES = {"temp_f": (40, 100), "humidity": (5, 95)}
+
+
+def within(bounds, limits):
+    """`bounds` narrowed to `limits`; falls back to `limits` if they don't overlap."""
+    low, high = max(bounds[0], limits[0]), min(bounds[1], limits[1])
+    return (low, high) if low <= high else limits
+
+
+class Sensor:
+    """One simulated thermo-hygrometer with a slowly drifting reading."""
+
+    def __init__(self, index, mac, sku, room, gateways, rng):
+        self.mac = mac
+        self.sku = sku
+        self.name = f"sim_{sku.lower()}_{index:05d}"
+        self.room = room
+        self.gateways = gateways  # [(gateway index, base RSSI)], nearest first
+        # Keep the walk inside what the raw layout can carry (H5051 humidity
+        # tops out at 25.5%, H5075 at 48%) so raw and pre-decoded adverts agree
+        fields = ble_decoder.ACTIVE_SPECS[sku]["fields"]
+        self.walk = {name: within(WALK_RANGES[name], field_limits(fields[name])) for name in WALK_RANGES}
+        start = {name: within(START_RANGES[name], self.walk[name]) for name in START_RANGES}
+        self.temp_f = rng.uniform(*start["temp_f"])
+        self.humidity = rng.uniform(*start["humidity"])
+        self.battery = rng.randint(40, 100)
+
+    def advance(self, rng):
+        """Random-walk the reading for the next advert."""
+        low, high = self.walk["temp_f"]
+        self.temp_f = min(max(self.temp_f + rng.gauss(0, 0.05), low), high)
+        low, high = self.walk["humidity"]
+        self.humidity = min(max(self.humidity + rng.gauss(0, 0.1), low), high)
+        if rng.random() < 0.001:
+            self.battery = max(self.battery - 1, 1)
+
+
+def build_fleet(args, rng):
+    """Sensors with their gateway coverage; gateways sit on a line, sensors between them."""
+    skus = []
+    for entry in args.skus.split(","):
+        sku, _, weight = entry.partition("=")
+        skus.append((sku.strip().upper(), float(weight or 1)))
+    for sku, _ in skus:
+        # Encode with the layouts the decoder runs (decoder-specs.json included)
+        if sku not in ble_decoder.DECODERS or sku not in MODEL_IDS:
+            raise SystemExit(f"Unsupported SKU for the generator: {sku}")
+    rooms = [f"sim_room_{i:03d}" for i in range(args.rooms)]
+    sensors, macs = [], set()
+    for index in range(args.sensors):
+        mac = "A4C138" + "".join(rng.choice("0123456789ABCDEF") for _ in range(6))
+        if mac in macs:
+            continue
+        macs.add(mac)
+        position = rng.uniform(0, args.gateways)
+        nearest = sorted(range(args.gateways), key=lambda g: abs(g + 0.5 - position))[:args.coverage]
+        gateways = [(g, -50 - 25 * abs(g + 0.5 - position) / max(args.coverage, 1)) for g in nearest]
+        sku = rng.choices([sku for sku, _ in skus], [weight for _, weight in skus])[0]
+        sensors.append(Sensor(index, mac, sku, rng.choice(rooms), gateways, rng))
+    return sensors
+
+
+def write_overrides(path, sensors):
+    """device-overrides.json entries (name/room/sku) for every simulated sensor."""
+    overrides = {
+        "_comment": f"Simulated fleet from fleet_loadgen.py ({len(sensors)} sensors) - not real devices",
+    }
+    for sensor in sensors:
+        overrides[sensor.mac] = {"name": sensor.name, "room": sensor.room, "sku": sensor.sku}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(overrides, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+# ============================================================================
+# Traffic
+# ============================================================================
+
+def advert_payload(sensor, rssi, decoded, theengs=False):
+    """
+    Gateway JSON for one advert, raw or pre-decoded like the gateway firmware.
+    Pre-decoded values come from decoding the raw advert, so both forms agree.
+    """
+    values = {"temp_f": sensor.temp_f, "humidity": sensor.humidity, "battery": sensor.battery}
+    mfr = encode_advert(ble_decoder.ACTIVE_SPECS[sensor.sku], values)
+    payload = {
+        "id": colon_mac(sensor.mac),
+        "name": ADVERT_NAMES[sensor.sku].format(sensor.mac[-4:]),
+        "rssi": rssi,
+    }
+    if not theengs:
+        payload["mac_type"] = 0
+        payload["adv_type"] = 0
+    if not theengs or not decoded:
+        payload["manufacturerdata"] = mfr
+    if decoded:
+        reading = ble_decoder.DECODERS[sensor.sku](bytes.fromhex(mfr))
+        payload.update({
+            "brand": "Govee",
+            "model": "Thermo-Hygrometer",
+            "model_id": MODEL_IDS[sensor.sku],
+            "type": "THB",
+            "tempc": round((reading["temp_f"] - 32) * 5 / 9, 1),
+            "tempf": round(reading["temp_f"], 2),
+            "hum": round(reading["humidity"], 1),
+            "batt": reading["battery"],
+        })
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def junk_message(rng, sensors, gateway_topics):
+    """One message the decoder should drop: unknown MAC traffic or a name-only scan response."""
+    gateway = rng.choice(gateway_topics)
+    if sensors and rng.random() < 0.25:
+        sensor = rng.choice(sensors)
+        payload = {"id": colon_mac(sensor.mac), "mac_type": 0, "adv_type": 4,
+                   "name": ADVERT_NAMES[sensor.sku].format(sensor.mac[-4:]), "rssi": rng.randint(-95, -60)}
+        return f"{gateway}/{sensor.mac}", json.dumps(payload, separators=(",", ":"))
+    mac = "".join(rng.choice("0123456789ABCDEF") for _ in range(12))
+    payload = {"id": colon_mac(mac), "mac_type": 1, "adv_type": 0,
+               "manufacturerdata": rng.choice(JUNK_MANUFACTURER_DATA), "rssi": rng.randint(-100, -60)}
+    return f"{gateway}/{mac}", json.dumps(payload, separators=(",", ":"))
+
+
+def generate(args, sensors, rng):
+    """Yield (seconds, topic, payload) in time order until --duration."""
+    gateway_topics = [f"{ble_decoder.SHOWSITE}/{args.node_prefix}_{g}/BTtoMQTT" for g in range(args.gateways)]
+    decoding = set(rng.sample(range(args.gateways), round(args.gateways * args.decoding_gateways)))
+    theengs = {sensor.mac for sensor in sensors if rng.random() < args.theengs}
+
+    # (due, sequence, sensor index or -1 for junk, relayed (topic, payload) or None);
+    # sequence keeps heap order stable and unique, so messages are never compared
+    events = [(rng.uniform(0, args.interval), i, i, None) for i in range(len(sensors))]
+    sequence = len(events)
+    if args.junk_rate > 0:
+        events.append((rng.expovariate(args.junk_rate), sequence, -1, None))
+    heapq.heapify(events)
+
+    while events:
+        due, _, index, message = heapq.heappop(events)
+        if args.duration and due >= args.duration:
+            break
+        if message is not None:
+            yield (due, *message)
+            continue
+        sequence += 1
+        if index < 0:
+            topic, payload = junk_message(rng, sensors, gateway_topics)
+            yield due, topic, payload
+            heapq.heappush(events, (due + rng.expovariate(args.junk_rate), sequence, -1, None))
+            continue
+        sensor = sensors[index]
+        sensor.advance(rng)
+        relays = []
+        for offset, (gateway, base_rssi) in enumerate(sensor.gateways):
+            if rng.random() < args.loss:
+                continue
+            rssi = int(min(max(base_rssi + rng.gauss(0, 4), -100), -30))
+            # Gateways relay the same advert a few ms apart
+            relays.append((due + offset * rng.uniform(0.001, 0.02), f"{gateway_topics[gateway]}/{sensor.mac}",
+                           advert_payload(sensor, rssi, gateway in decoding)))
+        if sensor.mac in theengs:
+            rssi = int(min(max(-75 + rng.gauss(0, 6), -100), -30))
+            relays.append((due + 0.01, f"home/TheengsGateway/BTtoMQTT/{sensor.mac}",
+                           advert_payload(sensor, rssi, True, True)))
+        # Relays go back through the heap so other sensors' messages interleave in time order
+        for relay_due, topic, payload in relays:
+            sequence += 1
+            heapq.heappush(events, (relay_due, sequence, index, (topic, payload)))
+        sequence += 1
+        heapq.heappush(events, (due + args.interval * rng.uniform(0.9, 1.1), sequence, index, None))
+
+
+def expected_rate(args, sensors):
+    per_advert = args.coverage * (1 - args.loss) + args.theengs
+    return len(sensors) * per_advert / args.interval + args.junk_rate
+
+
+def publish(args, messages):
+    """Publish generated messages to the broker in real time, reporting rate and lag."""
+    clients = []
+    for i in range(args.connections):
+        client = mqtt.Client(client_id=f"fleet_loadgen_{os.getpid()}_{i}")
+        client.connect(args.broker, args.port, 60)
+        client.loop_start()
+        clients.append(client)
+    started = time.monotonic()
+    sent, next_report, lag = 0, started + 10, 0.0
+    try:
+        for due, topic, payload in messages:
+            delay = started + due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+            clients[hash(topic.rsplit("/", 1)[0]) % len(clients)].publish(topic, payload)
+            sent += 1
+            now = time.monotonic()
+            if now >= next_report:
+                print(f"{time.strftime('%H:%M:%S')} {sent} sent ({sent / (now - started):.0f}/s), "
+                      f"max lag {lag * 1000:.0f} ms")
+                next_report, lag = now + 10, 0.0
+    except KeyboardInterrupt:
+        pass
+    for client in clients:
+        client.disconnect()
+        client.loop_stop()
+    elapsed = time.monotonic() - started
+    print(f"Sent {sent} messages in {elapsed:.1f}s ({sent / max(elapsed, 1e-9):.0f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensors", type=int, default=1000)
+    parser.add_argument("--gateways", type=int, default=50, help="ESP32 gateways")
+    parser.add_argument("--skus", default="H5051=1,H5074=1,H5075=2", help="model mix as SKU=weight,...")
+    parser.add_argument("--rooms", type=int, default=40)
+    parser.add_argument("--interval", type=float, default=10, help="seconds between adverts per sensor")
+    parser.add_argument("--coverage", type=int, default=3, help="gateways hearing each sensor")
+    parser.add_argument("--loss", type=float, default=0.1, help="chance a gateway misses an advert")
+    parser.add_argument("--decoding-gateways", type=float, default=0.5,
+                        help="fraction of gateways that pre-decode (tempf/hum/batt)")
+    parser.add_argument("--theengs", type=float, default=0.1,
+                        help="fraction of sensors also heard by the Theengs gateway")
+    parser.add_argument("--junk-rate", type=float, default=50, help="unknown-device messages per second")
+    parser.add_argument("--node-prefix", default="dpx_sim", help="gateway node name prefix")
+    parser.add_argument("--duration", type=float, default=0, help="seconds (0 = until Ctrl-C; required with --capture)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--write-overrides", metavar="PATH", help="write the matching device-overrides.json and exit")
+    parser.add_argument("--force", action="store_true", help="overwrite an existing --write-overrides file")
+    parser.add_argument("--capture", metavar="PATH", help="write a decoder_replay.py capture instead of publishing")
+    parser.add_argument("--broker", default=ble_decoder.BROKER)
+    parser.add_argument("--port", type=int, default=ble_decoder.PORT)
+    parser.add_argument("--connections", type=int, default=1, help="MQTT connections to spread gateways over")
+    args = parser.parse_args()
+    if args.gateways < 1 or args.coverage < 1 or args.interval <= 0 or args.connections < 1:
+        parser.error("--gateways, --coverage, --connections and --interval must be positive")
+    if args.capture and not args.duration:
+        parser.error("--capture needs --duration")
+    args.coverage = min(args.coverage, args.gateways)
+
+    rng = random.Random(args.seed)
+    sensors = build_fleet(args, rng)
+    if args.write_overrides:
+        if os.path.exists(args.write_overrides) and not args.force:
+            raise SystemExit(f"{args.write_overrides} exists (use --force to overwrite)")
+        write_overrides(args.write_overrides, sensors)
+        print(f"Wrote {len(sensors)} simulated devices to {args.write_overrides}")
+        return
+
+    print(f"Fleet: {len(sensors)} sensors, {args.gateways} gateways (coverage {args.coverage}, "
+          f"{args.decoding_gateways:.0%} pre-decoding), ~{expected_rate(args, sensors):.0f} msg/s")
+    messages = generate(args, sensors, rng)
+    if args.capture:
+        writer = CaptureWriter(args.capture)
+        for due, topic, payload in messages:
+            writer.write(due, topic, payload.encode())
+        writer.close()
+        print(f"Wrote {writer.count} messages ({args.duration:g}s) to {args.capture}")
+        return
+    print(f"Publishing to {args.broker}:{args.port} over {args.connections} connection(s)")
+    publish(args, messages)
+
+
+if __name__ == "__main__":
+    main()
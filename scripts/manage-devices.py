@@ -5,6 +5,7 @@ Manages local device name/room overrides for govee2mqtt devices.
 """
 
 import csv
+import hashlib
 import json
 import os
 import re
@@ -12,6 +13,7 @@ import subprocess
 import sys
 import urllib.request
 import tempfile
+import time
 from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
@@ -33,6 +35,9 @@ except:
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 REPO_ROOT = os.path.dirname(SCRIPT_DIR)
 OVERRIDE_FILE = os.path.join(REPO_ROOT, "telegraf", "conf.d", "device-overrides.json")
+MAPPINGS_FILE = os.path.join(REPO_ROOT, "telegraf", "conf.d", "device-mappings.conf")
+MAPPINGS_LOG = os.path.join(SCRIPT_DIR, "update-device-map.log")
+COMPOSE_FILE = os.path.join(REPO_ROOT, "docker-compose.yml")
 API_URL = "http://localhost:8056/api/devices"
 API_TIMEOUT = 5
 
@@ -141,6 +146,32 @@ def load_api_devices() -> Optional[List[Dict]]:
         return None
 
 
+def load_registry_devices() -> Optional[List[Dict]]:
+    """
+    Read the retained device table published by device_registry.py
+    (overrides already applied) via mosquitto_sub in the broker container.
+    """
+    showsite = get_env_value("SHOWSITE_NAME", "demo_showsite")
+    topic = f"{showsite}/dpx_ops_registry/devices"
+    cmd = ["docker", "exec", "mosquitto", "mosquitto_sub", "-t", topic, "-C", "1", "-W", "5"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+        if result.returncode != 0 or not result.stdout.strip():
+            print(f"Registry read failed: {result.stderr.strip() or 'no retained message'}", file=sys.stderr)
+            return None
+        registry = json.loads(result.stdout)
+    except Exception as e:
+        print(f"Registry read failed: {e}", file=sys.stderr)
+        return None
+    
+    # Registry keys are MAC suffixes; overrides may be written with colons or in lowercase
+    overridden = {get_mac_suffix(mac) for mac in load_overrides() if not mac.startswith("_")}
+    return [
+        {"mac": mac, "name": name, "room": room, "sku": sku, "has_override": mac in overridden}
+        for mac, (name, room, sku) in registry["devices"].items()
+    ]
+
+
 def merge_devices(api_data: Optional[List[Dict]], overrides: Dict[str, Dict]) -> List[Dict]:
     """
     Merge API data with local overrides.
@@ -191,6 +222,71 @@ def merge_devices(api_data: Optional[List[Dict]], overrides: Dict[str, Dict]) ->
     return devices
 
 
+def render_device_mappings(devices: List[Dict]) -> str:
+    """Render the Telegraf enum processor mapping z_device_id to device_name/room."""
+    name_lines = []
+    room_lines = []
+    for device in devices:
+        did = device["mac"]
+        name = device["name"].lower().replace(" ", "_")
+        room = (device.get("room") or "unassigned").lower().replace(" ", "_")
+        name_lines.append(f'      "{did}" = "{name}"')
+        room_lines.append(f'      "{did}" = "{room}"')
+    
+    return (
+        "[[processors.enum]]\n"
+        "  [[processors.enum.mapping]]\n"
+        "    tags = [\"z_device_id\"]\n"
+        "    dest = \"device_name\"\n"
+        "    [processors.enum.mapping.value_mappings]\n"
+        + "\n".join(name_lines) + "\n"
+        "\n"
+        "  [[processors.enum.mapping]]\n"
+        "    tags = [\"z_device_id\"]\n"
+        "    dest = \"room\"\n"
+        "    [processors.enum.mapping.value_mappings]\n"
+        + "\n".join(room_lines) + "\n"
+    )
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """Atomically replace path with content unless the hashes already match."""
+    new_hash = hashlib.sha256(content.encode()).hexdigest()
+    try:
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == new_hash:
+                return False
+    except FileNotFoundError:
+        pass
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), text=True)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return True
+
+
+def reload_containers(services: List[str]) -> bool:
+    """Send SIGHUP so Telegraf re-reads its config and ble-decoder re-polls the API."""
+    cmd = ["docker", "compose", "-f", COMPOSE_FILE, "kill", "-s", "HUP"] + services
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    except Exception as e:
+        print(f"Reload failed: {e}", file=sys.stderr)
+        return False
+    if result.returncode != 0:
+        print(f"Reload failed: {result.stderr.strip()}", file=sys.stderr)
+        return False
+    return True
+
+
 def validate_device_name(name: str, all_devices: List[Dict], exclude_mac: Optional[str] = None) -> Tuple[bool, str]:
     """
     Validate device name against rules.
@@ -1085,6 +1181,43 @@ def cmd_merge(args):
     return 0
 
 
+def cmd_update_map(args):
+    """Regenerate device-mappings.conf; write and reload only if it changed (cron entry point)."""
+    def log(line: str, details: Optional[List[str]] = None) -> None:
+        with open(MAPPINGS_LOG, 'a') as f:
+            f.write(f"{time.strftime('%a %b %d %H:%M:%S %Z %Y')} - {line}\n")
+            if details is not None:
+                f.writelines(f"{detail}\n" for detail in details)
+                f.write("\n")
+    
+    if '--from-registry' in args:
+        # Event-driven table from device_registry.py instead of polling the API
+        devices = load_registry_devices()
+    else:
+        api_data = load_api_devices()
+        devices = merge_devices(api_data, load_overrides()) if api_data else None
+    if not devices:
+        # Keep the last good mappings rather than writing an overrides-only file
+        log("Failed to fetch/merge devices. Skipping.")
+        return 1
+    
+    if not write_if_changed(MAPPINGS_FILE, render_device_mappings(devices)):
+        print(f"Device mappings unchanged ({len(devices)} devices)")
+        return 0
+    
+    print(f"Device mappings updated ({len(devices)} devices): {MAPPINGS_FILE}")
+    if '--no-reload' not in args:
+        if reload_containers(["telegraf", "ble-decoder"]):
+            print("✓ Sent reload (SIGHUP) to telegraf and ble-decoder")
+    
+    log("Device mappings updated (with overrides):", [
+        f"  {d['mac']}: {d['name'].lower().replace(' ', '_')} in "
+        f"{(d.get('room') or 'unassigned').lower().replace(' ', '_')}"
+        for d in devices
+    ])
+    return 0
+
+
 def cmd_delete_device_data(args):
     """Interactive deletion of historical device data from InfluxDB."""
     print(f"Device Data Deletion Tool v{VERSION}\n")
@@ -1120,6 +1253,8 @@ def main():
         print("  check-bad           - Detect devices with questionable names")
         print("  delete-device-data  - Delete InfluxDB data for renamed devices (interactive)")
         print("  merge               - Merge API data with overrides (JSON output)")
+        print("  update-map          - Regenerate Telegraf device-mappings.conf if changed")
+        print("                        [--no-reload] [--from-registry]")
         return 1
     
     command = sys.argv[1]
@@ -1133,6 +1268,7 @@ def main():
         'check-bad': cmd_check_bad,
         'delete-device-data': cmd_delete_device_data,
         'merge': cmd_merge,
+        'update-map': cmd_update_map,
     }
     
     if command not in commands:
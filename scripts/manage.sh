@@ -29,8 +29,8 @@ case "$1" in
       fi
       echo "✓ Existing instances stopped"
     fi
-    # Start new instance
-    cd "$SCRIPT_DIR" && source "$REPO_ROOT/.env" && python3 ble_decoder.py
+    # Start new instance (interactive: show every reading, not a sample)
+    cd "$SCRIPT_DIR" && source "$REPO_ROOT/.env" && DECODER_LOG_READINGS=all python3 ble_decoder.py
     ;;
   ble-up)   docker compose up -d ble-decoder ;;
   ble-down) docker compose stop ble-decoder ;;
@@ -90,8 +90,8 @@ case "$1" in
       read -p "Restart services to apply changes? [Y/n] " -n 1 -r
       echo
       if [[ ! $REPLY =~ ^[Nn]$ ]]; then
-        docker compose restart ble-decoder telegraf
-        echo "✓ Services restarted"
+        docker compose restart telegraf
+        echo "✓ Telegraf restarted (ble-decoder reloads overrides on its own)"
       fi
     fi
     ;;
@@ -102,8 +102,8 @@ case "$1" in
       read -p "Restart services to apply changes? [Y/n] " -n 1 -r
       echo
       if [[ ! $REPLY =~ ^[Nn]$ ]]; then
-        docker compose restart ble-decoder telegraf
-        echo "✓ Services restarted"
+        docker compose restart telegraf
+        echo "✓ Telegraf restarted (ble-decoder reloads overrides on its own)"
       fi
     fi
     ;;
@@ -114,8 +114,8 @@ case "$1" in
       read -p "Restart services to apply changes? [Y/n] " -n 1 -r
       echo
       if [[ ! $REPLY =~ ^[Nn]$ ]]; then
-        docker compose restart ble-decoder telegraf
-        echo "✓ Services restarted"
+        docker compose restart telegraf
+        echo "✓ Telegraf restarted (ble-decoder reloads overrides on its own)"
       fi
     fi
     ;;